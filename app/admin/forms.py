@@ -1,12 +1,10 @@
 # coding:utf8
 from flask_wtf import FlaskForm
-from wtforms import StringField, PasswordField, SubmitField, FileField, TextAreaField, SelectField, SelectMultipleField
+from wtforms import StringField, PasswordField, SubmitField, FileField, TextAreaField, SelectField, SelectMultipleField, \
+    HiddenField
 from wtforms.validators import DataRequired, ValidationError, EqualTo
 from app.models import Admin, Tag, Auth, Role
-
-tags = Tag.query.all()
-auth_list = Auth.query.all()
-role_list = Role.query.all()
+from app.cache import table_cache
 
 
 class LoginForm(FlaskForm):
@@ -95,6 +93,8 @@ class MovieForm(FlaskForm):
             "required": False
         }
     )
+    # 分块上传完成后的上传id，提交后代替 url 中的文件
+    upload_id = HiddenField()
     info = TextAreaField(
         label="简介",
         validators=[
@@ -135,7 +135,6 @@ class MovieForm(FlaskForm):
             DataRequired("请选择标签")
         ],
         coerce=int,
-        choices=[(v.id, v.name) for v in tags],
         description='标签',
         render_kw={
             "class": "form-control"
@@ -185,6 +184,11 @@ class MovieForm(FlaskForm):
         }
     )
 
+    # 选项在表单实例化时从缓存读取，导入模块时不访问数据库
+    def __init__(self, *args, **kwargs):
+        super(MovieForm, self).__init__(*args, **kwargs)
+        self.tag_id.choices = [(v.id, v.name) for v in table_cache.all(Tag)]
+
 
 class PreviewForm(FlaskForm):
     title = StringField(
@@ -313,7 +317,6 @@ class RoleForm(FlaskForm):
             DataRequired('请选择权限')
         ],
         coerce=int,
-        choices=[(v.id, v.name) for v in auth_list],
         description="权限列表",
         render_kw={
             "class": "form-control",
@@ -327,6 +330,10 @@ class RoleForm(FlaskForm):
         }
     )
 
+    def __init__(self, *args, **kwargs):
+        super(RoleForm, self).__init__(*args, **kwargs)
+        self.auths.choices = [(v.id, v.name) for v in table_cache.all(Auth)]
+
 
 class AdminForm(FlaskForm):
     name = StringField(
@@ -372,7 +379,6 @@ class AdminForm(FlaskForm):
             DataRequired("请输入所属角色！")
         ],
         coerce=int,
-        choices=[(v.id, v.name) for v in role_list],
         description="所属角色",
         render_kw={
             "class": "form-control",
@@ -385,3 +391,7 @@ class AdminForm(FlaskForm):
             "class": "btn btn-primary"
         }
     )
+
+    def __init__(self, *args, **kwargs):
+        super(AdminForm, self).__init__(*args, **kwargs)
+        self.role_id.choices = [(v.id, v.name) for v in table_cache.all(Role)]
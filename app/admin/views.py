@@ -1,14 +1,24 @@
 # coding:utf8
 from . import admin
-from flask import render_template, redirect, url_for, flash, session, request, abort
+from flask import render_template, redirect, url_for, flash, session, request, abort, current_app
 from app.admin.forms import LoginForm, TagForm, MovieForm, PreviewForm, PwdForm, AuthForm, RoleForm, AdminForm
 from app.models import Admin, Tag, Movie, Preview, User, Comment, Moviecol, Oplog, Adminlog, Userlog, Auth, Role
 from functools import wraps
-from app import db, app
+from app import db, audit_log, log_retention
+from app.counters import incr_commentnum
+from app.pagination import cached_paginate, keyset_paginate
+from app.search import title_index
+from app.cache import table_cache
+from app.upload import chunked_upload
+from app.passwords import password_hasher
+from app.media import media
+from app.pool import pool_stats
+from app.profiler import sql_profiler
+from app.store import store
 from werkzeug.utils import secure_filename
-import os
-import uuid
+from sqlalchemy.orm import contains_eager, undefer
 import datetime
+import json
 
 
 # 上下应用处理器
@@ -31,37 +41,46 @@ def admin_login_req(f):
     return decorated_function
 
 
+# 每个角色允许访问的url规则，由 Role.auths 与 Auth 表编译为 frozenset
+_role_urls = {}
+
+
+@table_cache.on_invalidate
+def _clear_role_urls(table):
+    if table in (None, "role", "auth"):
+        _role_urls.clear()
+
+
+def role_urls(role_id):
+    urls = _role_urls.get(role_id)
+    if urls is None:
+        role = table_cache.get(Role, role_id, reload=True)
+        auths = role.auths.split(",") if role is not None and role.auths else []
+        ids = set(int(v) for v in auths if v.strip())
+        # 引用了缓存中没有的权限时重新加载一次权限表
+        if any(table_cache.get(Auth, v) is None for v in ids):
+            table_cache.invalidate(Auth)
+        urls = frozenset(v.url for v in table_cache.all(Auth) if v.id in ids)
+        _role_urls[role_id] = urls
+    return urls
+
+
 # 权限控制装饰器
 def admin_auth(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        admin = Admin.query.join(
-            Role
-        ).filter(
-            Role.id == Admin.role_id,
-            Admin.id == session['admin_id']
-        ).first()
-
+        admin = table_cache.get(Admin, session['admin_id'], reload=True)
+        if admin is None:
+            abort(404)
         if admin.is_super != 0:
-            auths = admin.role.auths
-            auths = list(map(lambda v: int(v), auths.split(",")))
-            auth_list = Auth.query.all()
-            urls = [v.url for v in auth_list for val in auths if val == v.id]
             rule = request.url_rule
-            if str(rule) not in urls:
+            if str(rule) not in role_urls(admin.role_id):
                 abort(404)
         return f(*args, **kwargs)
 
     return decorated_function
 
 
-# 修改文件名称
-def change_filename(filename):
-    fileinfo = os.path.splitext(filename)
-    filename = datetime.datetime.now().strftime("%Y%m%d%H%M%S") + str(uuid.uuid4().hex) + fileinfo[-1]
-    return filename
-
-
 # 后台首页
 @admin.route("/")
 @admin_login_req
@@ -82,12 +101,15 @@ def login():
             return redirect(url_for('admin.login'))
         session['admin'] = data['account']
         session['admin_id'] = admin.id
-        adminlog = Adminlog(
+        # 旧参数计算的哈希在登录成功时按当前配置重新计算
+        if password_hasher.needs_rehash(admin.pwd):
+            admin.pwd = password_hasher.hash(data['pwd'])
+            db.session.commit()
+        audit_log.write(
+            Adminlog,
             admin_id=admin.id,
             ip=request.remote_addr
         )
-        db.session.add(adminlog)
-        db.session.commit()
         return redirect(request.args.get("next") or url_for("admin.index"))
     return render_template('admin/login.html', form=form)
 
@@ -109,8 +131,7 @@ def pwd():
     if form.validate_on_submit():
         data = form.data
         admin = Admin.query.filter_by(name=session['admin']).first()
-        from werkzeug.security import generate_password_hash
-        admin.pwd = generate_password_hash(data['new_pwd'])
+        admin.pwd = password_hasher.hash(data['new_pwd'])
         db.session.add(admin)
         db.session.commit()
         flash('修改密码成功，请重新登录！', 'ok')
@@ -136,13 +157,12 @@ def tag_add():
         db.session.add(tag)
         db.session.commit()
         flash('添加成功', 'ok')
-        oplog = Oplog(
+        audit_log.write(
+            Oplog,
             admin_id=session["admin_id"],
             ip=request.remote_addr,
             reason="添加标签%s" % data["name"]
         )
-        db.session.add(oplog)
-        db.session.commit()
         return redirect(url_for('admin.tag_add'))
     return render_template('admin/tag_add.html', form=form)
 
@@ -152,11 +172,9 @@ def tag_add():
 @admin_login_req
 @admin_auth
 def tag_list(page=None):
-    if page == None:
-        page = 1
-    page_data = Tag.query.order_by(
+    page_data = cached_paginate(Tag.query.order_by(
         Tag.addtime.desc()
-    ).paginate(page=page, per_page=10)
+    ), page=page, estimate=True)
     return render_template('admin/tag_list.html', page_data=page_data)
 
 
@@ -193,23 +211,107 @@ def tag_edit(id=None):
     return render_template('admin/tag_edit.html', form=form, tag=tag)
 
 
+# 分块上传接口的权限：角色需要有添加电影或编辑电影的权限
+def upload_auth(f):
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        admin = table_cache.get(Admin, session['admin_id'], reload=True)
+        if admin is None:
+            abort(404)
+        if admin.is_super != 0:
+            urls = role_urls(admin.role_id)
+            rules = [str(v) for e in ("admin.movie_add", "admin.movie_edit")
+                     for v in current_app.url_map.iter_rules(e)]
+            if not any(v in urls for v in rules):
+                abort(404)
+        return f(*args, **kwargs)
+
+    return decorated_function
+
+
+# 认领分块上传完成的视频，返回保存后的文件名
+def claim_upload(upload_id):
+    return chunked_upload.claim(upload_id, lambda path, meta: store.put(
+        path, meta['filename'], meta['checksum'], meta['chunk_size']
+    ))
+
+
+# 分块上传：创建上传会话
+@admin.route("/upload/", methods=['POST'])
+@admin_login_req
+@upload_auth
+def upload_create():
+    try:
+        data = chunked_upload.create(
+            secure_filename(request.form.get('filename', '')),
+            int(request.form.get('size', -1))
+        )
+    except ValueError as e:
+        return json.dumps(dict(ok=0, msg=str(e))), 400
+    data['ok'] = 1
+    return json.dumps(data)
+
+
+# 分块上传：查询已收到的分块，用于断点续传
+@admin.route("/upload/<upload_id>/", methods=['GET'])
+@admin_login_req
+@upload_auth
+def upload_status(upload_id=None):
+    try:
+        data = chunked_upload.status(upload_id)
+    except ValueError as e:
+        return json.dumps(dict(ok=0, msg=str(e))), 404
+    data['ok'] = 1
+    return json.dumps(data)
+
+
+# 分块上传：请求体即分块内容，直接写入最终偏移量
+@admin.route("/upload/<upload_id>/<int:index>/", methods=['PUT'])
+@admin_login_req
+@upload_auth
+def upload_chunk(upload_id=None, index=None):
+    try:
+        checksum = chunked_upload.write_chunk(
+            upload_id, index, request.stream, request.headers.get('X-Chunk-Checksum')
+        )
+    except ValueError as e:
+        return json.dumps(dict(ok=0, msg=str(e))), 400
+    return json.dumps(dict(ok=1, index=index, checksum=checksum))
+
+
+# 分块上传：全部分块到齐后完成上传
+@admin.route("/upload/<upload_id>/finish/", methods=['POST'])
+@admin_login_req
+@upload_auth
+def upload_finish(upload_id=None):
+    try:
+        data = chunked_upload.finish(upload_id)
+    except ValueError as e:
+        return json.dumps(dict(ok=0, msg=str(e))), 400
+    data['ok'] = 1
+    return json.dumps(data)
+
+
 # 添加电影页面
 @admin.route("/movie/add/", methods=['GET', 'POST'])
 @admin_login_req
 @admin_auth
 def movie_add():
     form = MovieForm()
+    if form.upload_id.data:
+        form.url.validators = []
     if form.validate_on_submit():
         data = form.data
-        file_url = secure_filename(form.url.data.filename)
-        file_logo = secure_filename(form.logo.data.filename)
-        if not os.path.exists((app.config['UP_DIR'])):
-            os.makedirs(app.config['UP_DIR'])
-            os.chmod(app.config['UP_DIR'], "rw")
-        url = change_filename(file_url)
-        logo = change_filename(file_logo)
-        form.url.data.save(app.config['UP_DIR'] + url)
-        form.logo.data.save(app.config['UP_DIR'] + logo)
+        if data['upload_id']:
+            try:
+                url = claim_upload(data['upload_id'])
+            except ValueError as e:
+                flash(str(e), 'err')
+                return redirect(url_for('admin.movie_add'))
+        else:
+            url = store.save(form.url.data)
+        logo = store.save(form.logo.data)
+        media.submit(logo, 'movie')
         movie = Movie(
             title=data["title"],
             url=url,
@@ -225,23 +327,27 @@ def movie_add():
         )
         db.session.add(movie)
         db.session.commit()
+        title_index.update(movie)
         flash("添加电影成功", "ok")
         return redirect(url_for('admin.movie_add'))
     return render_template('admin/movie_add.html', form=form)
 
 
+# 电影列表页面只渲染以下字段，按列查询得到轻量的只读记录
+MOVIE_LIST_COLUMNS = (
+    Movie.id, Movie.title, Movie.length, Movie.area, Movie.star,
+    Movie.playnum, Movie.commentnum, Movie.addtime, Tag.name.label("tag_name")
+)
+
+
 # 电影列表页面
 @admin.route("/movie/list/<int:page>", methods=["GET"])
 @admin_login_req
 @admin_auth
 def movie_list(page=None):
-    if page == None:
-        page = 1
-    page_data = Movie.query.join(Tag).filter(
-        Tag.id == Movie.tag_id
-    ).order_by(
-        Movie.addtime.desc()
-    ).paginate(page=page, per_page=10)
+    page_data = keyset_paginate(db.session.query(*MOVIE_LIST_COLUMNS).select_from(Movie).join(
+        Tag, Tag.id == Movie.tag_id
+    ), [(Movie.addtime, 'desc')], page=page)
     return render_template('admin/movie_list.html', page_data=page_data)
 
 
@@ -253,6 +359,7 @@ def movie_del(id=None):
     movie = Movie.query.get_or_404(int(id))
     db.session.delete(movie)
     db.session.commit()
+    title_index.delete(int(id))
     flash("删除电影成功", "ok")
     return redirect(url_for('admin.movie_list', page=1))
 
@@ -265,7 +372,7 @@ def movie_edit(id=None):
     form = MovieForm()
     form.url.validators = []
     form.logo.validators = []
-    movie = Movie.query.get_or_404(int(id))
+    movie = Movie.query.options(undefer("info")).get_or_404(int(id))
     if request.method == 'GET':
         form.info.data = movie.info
         form.tag_id.data = movie.tag_id
@@ -277,21 +384,20 @@ def movie_edit(id=None):
         if movie_count == 1 and movie.title == data['title']:
             flash('片名已经存在', 'err')
             return redirect(url_for('admin.movie_edit', id=int(id)))
-        # 判断文件是否存在
-        if not os.path.exists((app.config['UP_DIR'])):
-            os.makedirs(app.config['UP_DIR'])
-            os.chmod(app.config['UP_DIR'], "rw")
-        # 判断是否含有属性filename，及判断是否重新上传了视频
-        if hasattr(form.url.data, 'filename'):
-            file_url = secure_filename(form.url.data.filename)
-            movie.url = change_filename(file_url)
-            form.url.data.save(app.config['UP_DIR'] + movie.url)
+        # 判断是否通过分块上传或含有属性filename，及判断是否重新上传了视频
+        if data['upload_id']:
+            try:
+                movie.url = claim_upload(data['upload_id'])
+            except ValueError as e:
+                flash(str(e), 'err')
+                return redirect(url_for('admin.movie_edit', id=int(id)))
+        elif hasattr(form.url.data, 'filename'):
+            movie.url = store.save(form.url.data)
 
         # 判断是否含有属性filename，及判断是否重新上传了封面
         if hasattr(form.logo.data, 'filename'):
-            file_logo = secure_filename(form.logo.data.filename)
-            movie.logo = change_filename(file_logo)
-            form.logo.data.save(app.config['UP_DIR'] + movie.logo)
+            movie.logo = store.save(form.logo.data)
+            media.submit(movie.logo, 'movie')
 
         movie.title = data['title']
         movie.info = data['info']
@@ -302,6 +408,7 @@ def movie_edit(id=None):
         movie.release_time = data['release_time']
         db.session.add(movie)
         db.session.commit()
+        title_index.update(movie)
         flash('修改电影成功', 'ok')
         return redirect(url_for('admin.movie_edit', id=int(id)))
     return render_template('admin/movie_edit.html', form=form, movie=movie)
@@ -315,12 +422,8 @@ def preview_add():
     form = PreviewForm()
     if form.validate_on_submit():
         data = form.data
-        file_logo = secure_filename(form.logo.data.filename)
-        if not os.path.exists((app.config['UP_DIR'])):
-            os.makedirs(app.config['UP_DIR'])
-            os.chmod(app.config['UP_DIR'], "rw")
-        logo = change_filename(file_logo)
-        form.logo.data.save(app.config['UP_DIR'] + logo)
+        logo = store.save(form.logo.data)
+        media.submit(logo, 'preview')
         preview = Preview(
             title=data['title'],
             logo=logo
@@ -337,11 +440,9 @@ def preview_add():
 @admin_login_req
 @admin_auth
 def preview_list(page=None):
-    if page == None:
-        page = 1
-    page_data = Preview.query.order_by(
+    page_data = cached_paginate(Preview.query.order_by(
         Preview.addtime.desc()
-    ).paginate(page=page, per_page=10)
+    ), page=page, estimate=True)
     return render_template('admin/preview_list.html', page_data=page_data)
 
 
@@ -370,9 +471,8 @@ def preview_edit(id=None):
     if form.validate_on_submit():
         data = form.data
         if hasattr(form.logo.data, 'filename'):
-            file_logo = secure_filename(form.logo.data.filename)
-            preview.logo = change_filename(file_logo)
-            form.logo.data.save(app.config['UP_DIR'] + preview.logo)
+            preview.logo = store.save(form.logo.data)
+            media.submit(preview.logo, 'preview')
         preview.title = data['title']
         db.session.add(preview)
         db.session.commit()
@@ -386,11 +486,7 @@ def preview_edit(id=None):
 @admin_login_req
 @admin_auth
 def user_list(page=None):
-    if page == None:
-        page = 1
-    page_data = User.query.order_by(
-        User.id.desc()
-    ).paginate(page=page, per_page=10)
+    page_data = keyset_paginate(User.query, [(User.id, 'desc')], page=page)
     return render_template('admin/user_list.html', page_data=page_data)
 
 
@@ -420,18 +516,17 @@ def user_view(id=None):
 @admin_login_req
 @admin_auth
 def comment_list(page=None):
-    if page is None:
-        page = 1
-    page_data = Comment.query.join(
+    page_data = keyset_paginate(Comment.query.join(
         Movie
     ).join(
         User
     ).filter(
         Movie.id == Comment.movie_id,
         User.id == Comment.user_id
-    ).order_by(
-        Comment.id.desc()
-    ).paginate(page=page, per_page=10)
+    ).options(
+        contains_eager(Comment.movie).load_only("id", "title"),
+        contains_eager(Comment.user).load_only("id", "name", "face")
+    ), [(Comment.id, 'desc')], page=page)
     return render_template('admin/comment_list.html', page_data=page_data)
 
 
@@ -442,6 +537,7 @@ def comment_list(page=None):
 def comment_del(id=None):
     comment = Comment.query.get_or_404(int(id))
     db.session.delete(comment)
+    incr_commentnum(comment.movie_id, -1)
     db.session.commit()
     flash('删除评论成功', 'ok')
     return redirect(url_for('admin.comment_list', page=1))
@@ -452,18 +548,17 @@ def comment_del(id=None):
 @admin_login_req
 @admin_auth
 def moviecol_list(page=None):
-    if page is None:
-        page = 1
-    page_data = Moviecol.query.join(
+    page_data = keyset_paginate(Moviecol.query.join(
         Movie
     ).join(
         User
     ).filter(
         Movie.id == Moviecol.movie_id,
         User.id == Moviecol.user_id
-    ).order_by(
-        Moviecol.id.desc()
-    ).paginate(page=page, per_page=10)
+    ).options(
+        contains_eager(Moviecol.movie).load_only("id", "title"),
+        contains_eager(Moviecol.user).load_only("id", "name")
+    ), [(Moviecol.id, 'desc')], page=page)
     return render_template('admin/moviecol_list.html', page_data=page_data)
 
 
@@ -484,16 +579,16 @@ def moviecol_del(id=None):
 @admin_login_req
 @admin_auth
 def oplog_list(page=None):
-    if page == None:
-        page = 1
-    page_data = Oplog.query.join(
+    history = log_retention.history()
+    page_data = keyset_paginate(log_retention.hot(Oplog.query.join(
         Admin
     ).filter(
         Admin.id == Oplog.admin_id,
-    ).order_by(
-        Oplog.addtime.desc()
-    ).paginate(page=page, per_page=10)
-    return render_template('admin/oplog_list.html', page_data=page_data)
+    ).options(
+        contains_eager(Oplog.admin).load_only("id", "name")
+    ), Oplog.addtime, history), [(Oplog.addtime, 'desc')], page=page)
+    return render_template('admin/oplog_list.html', page_data=page_data, history=history,
+                           hot_days=log_retention.hot_days)
 
 
 # 管理员登录日志列表页面
@@ -501,16 +596,16 @@ def oplog_list(page=None):
 @admin_login_req
 @admin_auth
 def adminloginlog_list(page=None):
-    if page == None:
-        page = 1
-    page_data = Adminlog.query.join(
+    history = log_retention.history()
+    page_data = keyset_paginate(log_retention.hot(Adminlog.query.join(
         Admin
     ).filter(
         Admin.id == Adminlog.admin_id,
-    ).order_by(
-        Adminlog.addtime.desc()
-    ).paginate(page=page, per_page=10)
-    return render_template('admin/adminloginlog_list.html', page_data=page_data)
+    ).options(
+        contains_eager(Adminlog.admin).load_only("id", "name")
+    ), Adminlog.addtime, history), [(Adminlog.addtime, 'desc')], page=page)
+    return render_template('admin/adminloginlog_list.html', page_data=page_data, history=history,
+                           hot_days=log_retention.hot_days)
 
 
 # 会员登录日志列表页面
@@ -518,16 +613,16 @@ def adminloginlog_list(page=None):
 @admin_login_req
 @admin_auth
 def userloginlog_list(page=None):
-    if page == None:
-        page = 1
-    page_data = Userlog.query.join(
+    history = log_retention.history()
+    page_data = keyset_paginate(log_retention.hot(Userlog.query.join(
         User
     ).filter(
         User.id == Userlog.user_id,
-    ).order_by(
-        Userlog.addtime.desc()
-    ).paginate(page=page, per_page=10)
-    return render_template('admin/userloginlog_list.html', page_data=page_data)
+    ).options(
+        contains_eager(Userlog.user).load_only("id", "name")
+    ), Userlog.addtime, history), [(Userlog.addtime, 'desc')], page=page)
+    return render_template('admin/userloginlog_list.html', page_data=page_data, history=history,
+                           hot_days=log_retention.hot_days)
 
 
 # 角色添加页面
@@ -554,11 +649,9 @@ def role_add():
 @admin_login_req
 @admin_auth
 def role_list(page=None):
-    if page == None:
-        page = 1
-    page_data = Role.query.order_by(
+    page_data = cached_paginate(Role.query.order_by(
         Role.addtime.desc()
-    ).paginate(page=page, per_page=10)
+    ), page=page, estimate=True)
     return render_template('admin/role_list.html', page_data=page_data)
 
 
@@ -618,11 +711,9 @@ def auth_add():
 @admin_login_req
 @admin_auth
 def auth_list(page=None):
-    if page == None:
-        page = 1
-    page_data = Auth.query.order_by(
+    page_data = cached_paginate(Auth.query.order_by(
         Auth.addtime.desc()
-    ).paginate(page=page, per_page=10)
+    ), page=page, estimate=True)
     return render_template('admin/auth_list.html', page_data=page_data)
 
 
@@ -663,7 +754,6 @@ def auth_edit(id=None):
 def admin_add():
     form = AdminForm()
     if form.validate_on_submit():
-        from werkzeug.security import generate_password_hash
         data = form.data
         admin = Admin.query.filter_by(name=data['name']).count()
         if admin == 1:
@@ -672,7 +762,7 @@ def admin_add():
 
         admin = Admin(
             name=data['name'],
-            pwd=generate_password_hash(data['pwd']),
+            pwd=password_hasher.hash(data['pwd']),
             role_id=data['role_id'],
             is_super=1
         )
@@ -688,13 +778,36 @@ def admin_add():
 @admin_login_req
 @admin_auth
 def admin_list(page=None):
-    if page is None:
-        page = 1
-    page_data = Admin.query.join(
+    page_data = cached_paginate(Admin.query.join(
         Role
     ).filter(
         Role.id == Admin.role_id
     ).order_by(
         Admin.addtime.desc()
-    ).paginate(page=page, per_page=10)
+    ), page=page, estimate=True)
     return render_template('admin/admin_list.html', page_data=page_data)
+
+
+# 数据库连接池统计（当前进程）
+@admin.route("/pool/", methods=['GET'])
+@admin_login_req
+@admin_auth
+def pool_status():
+    return json.dumps(pool_stats.report(db.engine.pool))
+
+
+# SQL 性能统计：各端点被采样请求的语句数、耗时及疑似 N+1 的重复语句
+@admin.route("/sql/", methods=['GET', 'POST'])
+@admin_login_req
+@admin_auth
+def sql_profile():
+    if request.method == 'POST':
+        sql_profiler.reset()
+        flash('已清空统计', 'ok')
+        return redirect(url_for('admin.sql_profile'))
+    return render_template(
+        'admin/sql_profile.html',
+        rows=sql_profiler.report(),
+        profiler=sql_profiler,
+        pool=pool_stats.report(db.engine.pool)
+    )
@@ -0,0 +1,139 @@
+# coding:utf8
+import atexit
+import collections
+import datetime
+import logging
+import os
+import queue
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+# 登录日志及操作日志的异步写入
+# 请求中只把记录放入有界队列，由后台线程按表分组、用多行 INSERT 批量写入；
+# 队列已满时退回为在当前请求中同步写入，进程退出时等待后台线程结束（最多 stop_timeout 秒）后写完队列中剩余的记录
+class AuditLogWriter(object):
+    def __init__(self, db, interval=1, max_queue=10000, batch=500, stop_timeout=5):
+        self.db = db
+        self.interval = interval
+        self.max_queue = max_queue
+        self.batch = batch
+        self.stop_timeout = stop_timeout
+        self._reset()
+        atexit.register(self.stop)
+
+    def init_app(self, app):
+        self.interval = app.config.get("AUDIT_LOG_INTERVAL", self.interval)
+        self.max_queue = app.config.get("AUDIT_LOG_MAX_QUEUE", self.max_queue)
+        self.batch = app.config.get("AUDIT_LOG_BATCH", self.batch)
+        self.stop_timeout = app.config.get("AUDIT_LOG_STOP_TIMEOUT", self.stop_timeout)
+        self._reset()
+
+    # fork 之后子进程使用新的队列和线程，继承自父进程的记录由父进程自己写入
+    def _reset(self):
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._queue = queue.Queue(self.max_queue)
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def _check_pid(self):
+        if self._pid != os.getpid():
+            self._reset()
+
+    def _ensure_thread(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="auditlog-writer")
+                self._thread.daemon = True
+                self._thread.start()
+
+    # 写入一条 Userlog / Adminlog / Oplog 记录，addtime 取调用时的时间
+    def write(self, model, **values):
+        self._check_pid()
+        values.setdefault("addtime", datetime.datetime.now())
+        item = (model.__table__, values)
+        if not self._stopped.is_set():
+            try:
+                self._queue.put_nowait(item)
+                self._ensure_thread()
+                return
+            except queue.Full:
+                logger.warning("audit log queue full, writing synchronously")
+        self._insert([item])
+
+    def _take(self, timeout):
+        try:
+            items = [self._queue.get(timeout=timeout)]
+        except queue.Empty:
+            return []
+        while len(items) < self.batch:
+            try:
+                items.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return items
+
+    def _run(self):
+        while not self._stopped.is_set():
+            items = self._take(self.interval)
+            if not items:
+                continue
+            try:
+                self._insert(items)
+            except Exception:
+                logger.exception("audit log flush failed")
+                self._requeue(items)
+                self._stopped.wait(self.interval)
+
+    # 写入失败的记录放回队列等待重试，放不下的丢弃并记录日志
+    def _requeue(self, items):
+        dropped = 0
+        for item in items:
+            try:
+                self._queue.put_nowait(item)
+            except queue.Full:
+                dropped += 1
+        if dropped:
+            logger.error("audit log queue full, dropped %d records", dropped)
+
+    # 按表及字段分组，每组一条 executemany，驱动会改写为多行 INSERT
+    def _insert(self, items):
+        groups = collections.OrderedDict()
+        for table, values in items:
+            groups.setdefault((table, tuple(sorted(values))), []).append(values)
+        with self.db.engine.begin() as conn:
+            for (table, _), rows in groups.items():
+                conn.execute(table.insert(), rows)
+        return len(items)
+
+    # 同步写入队列中现有的全部记录
+    def flush(self):
+        self._check_pid()
+        count = 0
+        while True:
+            items = self._take(0)
+            if not items:
+                return count
+            try:
+                count += self._insert(items)
+            except Exception:
+                self._requeue(items)
+                raise
+
+    # 进程退出时停止后台线程并写入剩余记录
+    # 先等待后台线程写完手上的一批，避免与其同时写入；超时后仍写入剩余记录
+    def stop(self):
+        self._stopped.set()
+        thread = self._thread
+        if thread is not None and self._pid == os.getpid() and thread is not threading.current_thread():
+            thread.join(self.stop_timeout)
+            if thread.is_alive():
+                logger.warning("audit log writer did not stop in %s seconds", self.stop_timeout)
+        try:
+            self.flush()
+        except Exception:
+            logger.exception("audit log flush on shutdown failed")
@@ -0,0 +1,200 @@
+# coding:utf8
+import collections
+import hashlib
+import threading
+import time
+from functools import wraps
+
+from flask import current_app, make_response, request, session
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+
+# 小型参照表缓存（标签、权限、角色等）
+# 缓存的是只读的 namedtuple 记录而不是 ORM 对象，不依赖任何会话；
+# 本进程内提交了对应表的写入后立即失效，其他进程依靠 TTL 过期
+class TableCache(object):
+    def __init__(self, ttl=60):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._data = {}
+        self._types = {}
+        self._listeners = []
+
+    def init_app(self, app):
+        self.ttl = app.config.get("TABLE_CACHE_TTL", self.ttl)
+        event.listen(Session, "after_flush", self._after_flush)
+        event.listen(Session, "after_commit", self._after_commit)
+        event.listen(Session, "after_soft_rollback", self._after_rollback)
+
+    def _after_flush(self, session, flush_context):
+        tables = session.info.setdefault("table_cache_dirty", set())
+        for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+            table = getattr(obj, "__tablename__", None)
+            if table:
+                tables.add(table)
+
+    def _after_commit(self, session):
+        for table in session.info.pop("table_cache_dirty", ()):
+            self.invalidate(table)
+
+    def _after_rollback(self, session, previous_transaction):
+        session.info.pop("table_cache_dirty", None)
+
+    # 某张表失效时的回调，用于清理由该表派生出的其他缓存
+    def on_invalidate(self, f):
+        self._listeners.append(f)
+        return f
+
+    def invalidate(self, table=None):
+        if table is not None and not isinstance(table, str):
+            table = table.__tablename__
+        with self._lock:
+            if table is None:
+                self._data.clear()
+            else:
+                self._data.pop(table, None)
+        self._notify(table)
+
+    def _notify(self, table):
+        for f in self._listeners:
+            f(table)
+
+    def _record_type(self, model):
+        table = model.__tablename__
+        if table not in self._types:
+            keys = [c.key for c in model.__table__.columns]
+            self._types[table] = collections.namedtuple(model.__name__ + "Record", keys)
+        return self._types[table]
+
+    def _load(self, model):
+        table = model.__tablename__
+        now = time.time()
+        with self._lock:
+            hit = self._data.get(table)
+        if hit is not None and hit[0] > now:
+            return hit
+        from app import db
+        record = self._record_type(model)
+        cols = [getattr(model, k) for k in record._fields]
+        rows = tuple(record(*v) for v in db.session.query(*cols).order_by(model.id).all())
+        hit = (now + self.ttl, rows, dict((v.id, v) for v in rows))
+        with self._lock:
+            self._data[table] = hit
+        # 重新加载后内容可能已被其他进程修改，派生缓存同样需要失效
+        self._notify(table)
+        return hit
+
+    # 整张表的记录，按 id 排序
+    def all(self, model):
+        return self._load(model)[1]
+
+    # reload 为真时，缓存中找不到的记录重新加载一次整张表再查找，用于其他进程刚插入的记录
+    def get(self, model, id, reload=False):
+        row = self._load(model)[2].get(id)
+        if row is None and reload:
+            self.invalidate(model)
+            row = self._load(model)[2].get(id)
+        return row
+
+
+table_cache = TableCache()
+
+
+# 匿名访问的整页缓存
+# 以 (端点, 路由参数, 规范化后的查询参数) 为键缓存响应，带 TTL 及 LRU 容量上限，
+# 依赖的表发生写入时整体清空；响应头 X-Page-Cache 标明 HIT/MISS/BYPASS
+class PageCache(object):
+    def __init__(self, ttl=30, size=256):
+        self.ttl = ttl
+        self.size = size
+        self._lock = threading.Lock()
+        self._data = collections.OrderedDict()
+
+    def init_app(self, app):
+        self.ttl = app.config.get("PAGE_CACHE_TTL", self.ttl)
+        self.size = app.config.get("PAGE_CACHE_SIZE", self.size)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            hit = self._data.get(key)
+            if hit is None:
+                return None
+            if hit[0] <= now:
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return hit[1]
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.time() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.size:
+                self._data.popitem(last=False)
+
+    @staticmethod
+    def _normalize(value):
+        value = value.strip()
+        try:
+            return str(int(value))
+        except ValueError:
+            return value
+
+    def cached(self, args=(), tables=()):
+        def decorator(f):
+            if tables:
+                @table_cache.on_invalidate
+                def _clear(table):
+                    if table is None or table in tables:
+                        self.clear()
+
+            @wraps(f)
+            def decorated_function(*a, **kw):
+                if request.method != "GET" or "user" in session:
+                    resp = make_response(f(*a, **kw))
+                    resp.headers["X-Page-Cache"] = "BYPASS"
+                    return resp
+                key = (
+                    request.endpoint,
+                    tuple(sorted(kw.items())),
+                    tuple(self._normalize(request.args.get(v, "0")) for v in args)
+                )
+                hit = self.get(key)
+                if hit is not None:
+                    body, status, headers = hit
+                    resp = current_app.response_class(body, status=status, headers=headers)
+                    resp.headers["X-Page-Cache"] = "HIT"
+                    return resp.make_conditional(request)
+                resp = make_response(f(*a, **kw))
+                if resp.status_code == 200 and not resp.direct_passthrough:
+                    headers = [(k, v) for k, v in resp.headers.items() if k.lower() != "set-cookie"]
+                    self.set(key, (resp.get_data(), resp.status_code, headers))
+                resp.headers["X-Page-Cache"] = "MISS"
+                return resp
+
+            return decorated_function
+
+        return decorator
+
+
+page_cache = PageCache()
+
+
+# 条件请求
+# validators 为页面所渲染数据的摘要，据此生成 ETag；客户端的 If-None-Match 仍然有效时直接返回304，
+# 不调用 render 渲染模板。不设置 Last-Modified：页面数据的修改（标题、海报等）没有可靠的修改时间
+def conditional_response(validators, render):
+    etag = hashlib.md5(repr(validators).encode("utf8")).hexdigest()
+    if request.method in ("GET", "HEAD") and request.if_none_match and request.if_none_match.contains(etag):
+        resp = current_app.response_class(status=304)
+        resp.set_etag(etag)
+        return resp
+    resp = make_response(render())
+    resp.set_etag(etag)
+    return resp
@@ -0,0 +1,161 @@
+# coding:utf8
+import atexit
+import logging
+import os
+import threading
+
+from sqlalchemy import case, func
+
+logger = logging.getLogger(__name__)
+
+
+# 播放量写回缓冲
+# 按电影id在内存中累加播放次数，由后台线程定时批量写回 playnum = playnum + n，
+# 避免每次播放都对热点 movie 行做一次读-改-写并提交
+class PlayCounter(object):
+    def __init__(self, db, interval=5, max_pending=1000, stop_timeout=5):
+        self.db = db
+        self.interval = interval
+        self.max_pending = max_pending
+        self.stop_timeout = stop_timeout
+        self._reset()
+        atexit.register(self.stop)
+
+    def init_app(self, app):
+        self.interval = app.config.get("PLAYNUM_FLUSH_INTERVAL", self.interval)
+        self.max_pending = app.config.get("PLAYNUM_MAX_PENDING", self.max_pending)
+        self.stop_timeout = app.config.get("PLAYNUM_STOP_TIMEOUT", self.stop_timeout)
+
+    # fork 之后子进程重新初始化，继承自父进程的缓冲由父进程自己写回
+    def _reset(self):
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def _check_pid(self):
+        if self._pid != os.getpid():
+            self._reset()
+
+    def _ensure_thread(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="playnum-flusher")
+                self._thread.daemon = True
+                self._thread.start()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("playnum flush failed")
+
+    # 播放次数加 n
+    def incr(self, movie_id, n=1):
+        self._check_pid()
+        with self._lock:
+            self._pending[movie_id] = self._pending.get(movie_id, 0) + n
+            size = len(self._pending)
+        self._ensure_thread()
+        if size >= self.max_pending:
+            self.flush()
+
+    # 尚未写回的播放次数
+    def pending(self, movie_id):
+        with self._lock:
+            return self._pending.get(movie_id, 0)
+
+    # 将缓冲中的增量用一条 UPDATE 批量写回，失败时增量放回缓冲等待下次重试
+    def flush(self):
+        self._check_pid()
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return 0
+        from app.models import Movie
+        table = Movie.__table__
+        stmt = table.update().where(
+            table.c.id.in_(list(pending))
+        ).values(
+            playnum=func.coalesce(table.c.playnum, 0) + case(pending, value=table.c.id, else_=0)
+        )
+        try:
+            with self.db.engine.begin() as conn:
+                conn.execute(stmt)
+        except Exception:
+            with self._lock:
+                for movie_id, n in pending.items():
+                    self._pending[movie_id] = self._pending.get(movie_id, 0) + n
+            raise
+        return len(pending)
+
+    # 进程退出时停止后台线程并写回剩余增量
+    # 先等待后台线程完成正在进行的写回，写回失败放回缓冲的增量随后一并写回；超时后仍写回剩余增量
+    def stop(self):
+        self._stopped.set()
+        thread = self._thread
+        if thread is not None and self._pid == os.getpid() and thread is not threading.current_thread():
+            thread.join(self.stop_timeout)
+            if thread.is_alive():
+                logger.warning("playnum flusher did not stop in %s seconds", self.stop_timeout)
+        try:
+            self.flush()
+        except Exception:
+            logger.exception("playnum flush on shutdown failed")
+
+
+# 评论数加 n，在数据库端完成自增，与评论写入处于同一事务中
+def incr_commentnum(movie_id, n=1):
+    from app.models import Movie
+    return Movie.query.filter_by(id=movie_id).update(
+        {Movie.commentnum: func.coalesce(Movie.commentnum, 0) + n},
+        synchronize_session=False
+    )
+
+
+# 按 comment 表重新计算 commentnum，并修正非法的 playnum
+# 以电影id分批执行 GROUP BY，每批单独提交，避免长时间锁住整张表
+def reconcile_counters(db, batch=1000):
+    from app.models import Movie, Comment
+    last_id = 0
+    checked = fixed_comment = fixed_play = 0
+    while True:
+        rows = db.session.query(
+            Movie.id, Movie.commentnum
+        ).filter(
+            Movie.id > last_id
+        ).order_by(
+            Movie.id.asc()
+        ).limit(batch).all()
+        if not rows:
+            break
+        ids = [v.id for v in rows]
+        counts = dict(db.session.query(
+            Comment.movie_id, func.count(Comment.id)
+        ).filter(
+            Comment.movie_id.in_(ids)
+        ).group_by(
+            Comment.movie_id
+        ).all())
+        for v in rows:
+            real = counts.get(v.id, 0)
+            if v.commentnum == real:
+                continue
+            # 只有在读取之后没有被并发修改时才覆盖，否则留给下一次校准
+            old = Movie.commentnum.is_(None) if v.commentnum is None else Movie.commentnum == v.commentnum
+            fixed_comment += Movie.query.filter(
+                Movie.id == v.id,
+                old
+            ).update({Movie.commentnum: real}, synchronize_session=False)
+        fixed_play += Movie.query.filter(
+            Movie.id.in_(ids),
+            db.or_(Movie.playnum.is_(None), Movie.playnum < 0)
+        ).update({Movie.playnum: 0}, synchronize_session=False)
+        db.session.commit()
+        checked += len(rows)
+        last_id = ids[-1]
+    return dict(checked=checked, commentnum=fixed_comment, playnum=fixed_play)
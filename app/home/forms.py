@@ -3,6 +3,7 @@ from flask_wtf import FlaskForm
 from wtforms.fields import SubmitField, StringField, PasswordField, FileField, TextAreaField
 from wtforms.validators import DataRequired, EqualTo, Email, Regexp, ValidationError
 from app.models import User
+from app.uniqueness import user_uniqueness
 
 
 class RegistForm(FlaskForm):
@@ -76,22 +77,26 @@ class RegistForm(FlaskForm):
         }
     )
 
+    # 三个字段的唯一性一起检查，只在第一次调用时查询
+    def _taken(self):
+        if not hasattr(self, "_taken_fields"):
+            self._taken_fields = user_uniqueness.taken(
+                name=self.name.data,
+                email=self.email.data,
+                phone=self.phone.data
+            )
+        return self._taken_fields
+
     def validate_name(self, field):
-        name = field.data
-        user = User.query.filter_by(name=name).count()
-        if user == 1:
+        if "name" in self._taken():
             raise ValidationError('昵称已存在')
 
     def validate_email(self, field):
-        email = field.data
-        user = User.query.filter_by(email=email).count()
-        if user == 1:
+        if "email" in self._taken():
             raise ValidationError('邮箱已存在')
 
     def validate_phone(self, field):
-        phone = field.data
-        user = User.query.filter_by(phone=phone).count()
-        if user == 1:
+        if "phone" in self._taken():
             raise ValidationError('手机号已存在')
 
 
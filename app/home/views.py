@@ -1,22 +1,22 @@
 # coding:utf8
 from . import home
-from flask import render_template, redirect, url_for, flash, session, request
+from flask import render_template, redirect, url_for, flash, session, request, abort
+from flask_sqlalchemy import Pagination
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import contains_eager, undefer
 from functools import wraps
 from app.home.forms import RegistForm, LoginForm, UserdetailForm, PwdForm, CommentForm
 from app.models import User, Userlog, Preview, Tag, Movie, Comment, Moviecol
-from app import db, app
-from werkzeug.security import generate_password_hash
-from werkzeug.utils import secure_filename
+from app import db, play_counter, audit_log, log_retention
+from app.counters import incr_commentnum
+from app.pagination import check_page, keyset_paginate
+from app.search import title_index
+from app.cache import table_cache, page_cache, conditional_response
+from app.stream import send_range
+from app.store import store
+from app.uniqueness import user_uniqueness
+from app.passwords import password_hasher
 import uuid
-import os
-import datetime
-
-
-# 修改文件名称
-def change_filename(filename):
-    fileinfo = os.path.splitext(filename)
-    filename = datetime.datetime.now().strftime("%Y%m%d%H%M%S") + str(uuid.uuid4().hex) + fileinfo[-1]
-    return filename
 
 
 # 登录装饰器
@@ -42,12 +42,15 @@ def login():
             return redirect(url_for('home.login'))
         session['user'] = user.name
         session['user_id'] = user.id
-        userlog = Userlog(
+        # 旧参数计算的哈希在登录成功时按当前配置重新计算
+        if password_hasher.needs_rehash(user.pwd):
+            user.pwd = password_hasher.hash(data['pwd'])
+            db.session.commit()
+        audit_log.write(
+            Userlog,
             user_id=user.id,
             ip=request.remote_addr
         )
-        db.session.add(userlog)
-        db.session.commit()
         return redirect(url_for('home.user'))
     return render_template("home/login.html", form=form)
 
@@ -71,11 +74,16 @@ def regist():
             name=data["name"],
             email=data["email"],
             phone=data["phone"],
-            pwd=generate_password_hash(data['pwd']),
+            pwd=password_hasher.hash(data['pwd']),
             uuid=uuid.uuid4().hex
         )
         db.session.add(user)
-        db.session.commit()
+        try:
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            flash("昵称、邮箱或手机号已存在", "err")
+            return render_template("home/regist.html", form=form)
         flash("注册成功", "ok")
     return render_template("home/regist.html", form=form)
 
@@ -97,25 +105,22 @@ def user():
     if form.validate_on_submit():
         data = form.data
         if hasattr(form.face.data, 'filename'):
-            file_face = secure_filename(form.face.data.filename)
-            if not os.path.exists((app.config['FC_DIR'])):
-                os.makedirs(app.config['FC_DIR'])
-                os.chmod(app.config['FC_DIR'], "rw")
-            user.face = change_filename(file_face)
-            form.face.data.save(app.config['FC_DIR'] + user.face)
-
-        name_count = User.query.filter_by(name=data['name']).count()
-        if data['name'] != user.name and name_count == 1:
+            user.face = store.save(form.face.data, 'users/')
+
+        # 只检查修改过的字段
+        taken = user_uniqueness.taken(
+            exclude_id=user.id,
+            name=data['name'] if data['name'] != user.name else None,
+            email=data['email'] if data['email'] != user.email else None,
+            phone=data['phone'] if data['phone'] != user.phone else None
+        )
+        if 'name' in taken:
             flash('用户名已经存在', 'err')
             return redirect(url_for('home.user'))
-
-        email_count = User.query.filter_by(email=data['email']).count()
-        if data['email'] != user.email and email_count == 1:
+        if 'email' in taken:
             flash('邮箱已经存在', 'err')
             return redirect(url_for('home.user'))
-
-        phone_count = User.query.filter_by(phone=data['phone']).count()
-        if data['phone'] != user.phone and phone_count == 1:
+        if 'phone' in taken:
             flash('电话号码已经存在', 'err')
             return redirect(url_for('home.user'))
 
@@ -124,7 +129,12 @@ def user():
         user.phone = data['phone']
         user.info = data['info']
         db.session.add(user)
-        db.session.commit()
+        try:
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            flash('用户名、邮箱或电话号码已经存在', 'err')
+            return redirect(url_for('home.user'))
         flash('修改会员信息成功', 'ok')
         return redirect(url_for('home.user'))
     return render_template("home/user.html", form=form, user=user)
@@ -137,7 +147,7 @@ def pwd():
     if form.validate_on_submit():
         data = form.data
         user = User.query.filter_by(name=session['user']).first()
-        user.pwd = generate_password_hash(data['new_pwd'])
+        user.pwd = password_hasher.hash(data['new_pwd'])
         db.session.add(user)
         db.session.commit()
         flash('修改密码成功，请重新登录！', 'ok')
@@ -148,32 +158,28 @@ def pwd():
 @home.route("/comments/<int:page>/", methods=['GET'])
 @user_login_req
 def comments(page=None):
-    if page is None:
-        page = 1
-    page_data = Comment.query.join(
+    page_data = keyset_paginate(Comment.query.join(
         Movie
     ).join(
         User
     ).filter(
         Movie.id == Comment.movie_id,
         User.id == session["user_id"]
-    ).order_by(
-        Comment.id.desc()
-    ).paginate(page=page, per_page=10)
+    ).options(
+        contains_eager(Comment.user).load_only("id", "name", "face")
+    ), [(Comment.id, 'desc')], page=page)
     return render_template("home/comments.html", page_data=page_data)
 
 
 @home.route("/loginlog/<int:page>", methods=['GET'])
 @user_login_req
 def loginlog(page=None):
-    if page == None:
-        page = 1
-    page_data = Userlog.query.filter_by(
+    history = log_retention.history()
+    page_data = keyset_paginate(log_retention.hot(Userlog.query.filter_by(
         user_id=int(session['user_id'])
-    ).order_by(
-        Userlog.addtime.desc()
-    ).paginate(page=page, per_page=10)
-    return render_template("home/loginlog.html", page_data=page_data)
+    ), Userlog.addtime, history), [(Userlog.addtime, 'desc')], page=page)
+    return render_template("home/loginlog.html", page_data=page_data, history=history,
+                           hot_days=log_retention.hot_days)
 
 
 # 添加电影收藏
@@ -204,99 +210,105 @@ def moviecol_add():
 @home.route("/moviecol/<int:page>/", methods=['GET'])
 @user_login_req
 def moviecol(page=None):
-    if page == None:
-        page = 1
-    page_data = Moviecol.query.join(
+    page_data = keyset_paginate(Moviecol.query.join(
         Movie
     ).join(
         User
     ).filter(
         Movie.id == Moviecol.movie_id,
         User.id == int(session['user_id'])
-    ).order_by(
-        Moviecol.addtime.desc()
-    ).paginate(page=page, per_page=10)
+    ).options(
+        contains_eager(Moviecol.movie).load_only("id", "title", "logo", "info")
+    ), [(Moviecol.addtime, 'desc')], page=page)
     return render_template("home/moviecol.html", page_data=page_data)
 
 
-@home.route("/<int:page>/", methods=['GET'])
-def index(page=None):
-    tags = Tag.query.all()
-    page_data = Movie.query
+# 首页及搜索列表只渲染以下字段，按列查询得到轻量的只读记录，不经过 identity map
+INDEX_COLUMNS = (Movie.id, Movie.title, Movie.logo, Movie.star, Movie.playnum, Movie.commentnum, Movie.addtime)
+SEARCH_COLUMNS = (Movie.id, Movie.title, Movie.logo, Movie.info, Movie.addtime)
+
+
+# 首页电影列表的过滤条件及排序，未指定排序时按添加时间倒序
+def index_query(tid=0, star=0, time=0, pm=0, cm=0):
+    query = db.session.query(*INDEX_COLUMNS)
     # 标签
-    tid = request.args.get("tid", 0)
     if int(tid) != 0:
-        page_data = page_data.filter_by(tag_id=int(tid))
+        query = query.filter_by(tag_id=int(tid))
     # 星级
-    star = request.args.get("star", 0)
     if int(star) != 0:
-        page_data = page_data.filter_by(star=int(star))
+        query = query.filter_by(star=int(star))
+    order = []
     # 时间
-    time = request.args.get("time", 0)
     if int(time) != 0:
         if int(time) == 1:
-            page_data = page_data.order_by(
-                Movie.addtime.desc()
-            )
+            order.append((Movie.addtime, 'desc'))
         else:
-            page_data = page_data.order_by(
-                Movie.addtime.asc()
-            )
+            order.append((Movie.addtime, 'asc'))
     # 播放量
-    pm = request.args.get("pm", 0)
     if int(pm) != 0:
         if int(pm) == 1:
-            page_data = page_data.order_by(
-                Movie.playnum.desc()
-            )
+            order.append((Movie.playnum, 'desc'))
         else:
-            page_data = page_data.order_by(
-                Movie.playnum.asc()
-            )
+            order.append((Movie.playnum, 'asc'))
     # 评论数
-    cm = request.args.get("cm", 0)
     if int(cm) != 0:
         if int(cm) == 1:
-            page_data = page_data.order_by(
-                Movie.commentnum.desc()
-            )
+            order.append((Movie.commentnum, 'desc'))
         else:
-            page_data = page_data.order_by(
-                Movie.commentnum.asc()
-            )
-    if page is None:
-        page = 1
-    page_data = page_data.paginate(page=page, per_page=10)
+            order.append((Movie.commentnum, 'asc'))
+    if not order:
+        order.append((Movie.addtime, 'desc'))
+    return query, order
+
+
+@home.route("/<int:page>/", methods=['GET'])
+@page_cache.cached(args=("tid", "star", "time", "pm", "cm", "cursor"), tables=("movie", "tag"))
+def index(page=None):
+    tags = table_cache.all(Tag)
     p = dict(
-        tid=tid,
-        star=star,
-        time=time,
-        pm=pm,
-        cm=cm
+        tid=request.args.get("tid", 0),
+        star=request.args.get("star", 0),
+        time=request.args.get("time", 0),
+        pm=request.args.get("pm", 0),
+        cm=request.args.get("cm", 0)
+    )
+    query, order = index_query(**p)
+    page_data = keyset_paginate(query, order, page=page)
+    validators = (
+        tags, sorted(p.items()), page_data.page, page_data.has_prev, page_data.has_next,
+        [(v.id, v.title, v.logo, v.star) for v in page_data.items]
+    )
+    return conditional_response(
+        validators,
+        lambda: render_template('home/index.html', tags=tags, p=p, page_data=page_data)
     )
-    return render_template('home/index.html', tags=tags, p=p, page_data=page_data)
 
 
 @home.route("/animation/", methods=['GET'])
 def animation():
     data = Preview.query.all()
-    return render_template("home/animation.html", data=data)
+    validators = [(v.id, v.title, v.logo) for v in data]
+    return conditional_response(
+        validators,
+        lambda: render_template("home/animation.html", data=data)
+    )
 
 
 @home.route("/search/<int:page>", methods=['GET'])
 def search(page=None):
-    key = request.args.get('key')
-    movie_count = Movie.query.filter(
-        Movie.title.ilike('%' + key + '%')
-    ).count()
-    if page is None:
-        page = 1
-    page_data = Movie.query.filter(
-        Movie.title.ilike('%' + key + '%')
-    ).order_by(
-        Movie.addtime.desc()
-    ).paginate(page=page, per_page=10)
-    return render_template("home/search.html", page_data=page_data, key=key, movie_count=movie_count)
+    key = request.args.get('key', '')
+    page = check_page(page)
+    ids, movie_count = title_index.search(key, page=page, per_page=10)
+    movies = {}
+    if ids:
+        movies = dict((v.id, v) for v in db.session.query(*SEARCH_COLUMNS).filter(Movie.id.in_(ids)))
+    items = [movies[v] for v in ids if v in movies]
+    page_data = Pagination(None, page, 10, movie_count, items)
+    validators = (key, page, movie_count, [(v.id, v.title, v.logo, v.info) for v in items])
+    return conditional_response(
+        validators,
+        lambda: render_template("home/search.html", page_data=page_data, key=key, movie_count=movie_count)
+    )
 
 
 @home.route("/play/<int:id>/<int:page>/", methods=['GET', 'POST'])
@@ -304,23 +316,24 @@ def play(id=None, page=None):
     movie = Movie.query.join(Tag).filter(
         Tag.id == Movie.tag_id,
         Movie.id == int(id)
+    ).options(
+        contains_eager(Movie.tag),
+        undefer("info")
     ).first_or_404()
 
-    if page is None:
-        page = 1
-    page_data = Comment.query.join(
+    page_data = keyset_paginate(Comment.query.join(
         Movie
     ).join(
         User
     ).filter(
         Movie.id == movie.id,
         User.id == Comment.user_id
-    ).order_by(
-        Comment.id.desc()
-    ).paginate(page=page, per_page=10)
+    ).options(
+        contains_eager(Comment.user).load_only("id", "name", "face")
+    ), [(Comment.id, 'desc')], page=page)
 
     form = CommentForm()
-    movie.playnum = movie.playnum + 1
+    play_counter.incr(movie.id)
     if "user" in session and form.validate_on_submit():
         data = form.data
         comment = Comment(
@@ -329,12 +342,33 @@ def play(id=None, page=None):
             user_id=session['user_id']
         )
         db.session.add(comment)
-        db.session.commit()
-        movie.commentnum = movie.commentnum + 1
-        db.session.add(movie)
+        incr_commentnum(movie.id)
         db.session.commit()
         flash("评论成功", 'ok')
         return redirect(url_for('home.play', id=movie.id, page=1))
-    db.session.add(movie)
-    db.session.commit()
-    return render_template("home/play.html", movie=movie, form=form, page_data=page_data)
+    if "user" in session:
+        # 登录后页面包含评论表单的 CSRF 令牌，不能让浏览器复用旧页面
+        return render_template("home/play.html", movie=movie, form=form, page_data=page_data)
+    validators = (
+        (movie.id, movie.title, movie.url, movie.logo, movie.info, movie.star, movie.area,
+         str(movie.release_time), movie.length, movie.tag.name, movie.playnum, movie.commentnum),
+        page_data.page, page_data.has_prev, page_data.has_next,
+        [(v.id, v.content, str(v.addtime), v.user.name, v.user.face) for v in page_data.items]
+    )
+    return conditional_response(
+        validators,
+        lambda: render_template("home/play.html", movie=movie, form=form, page_data=page_data)
+    )
+
+
+# 电影视频流，支持拖动播放时的 Range 请求
+@home.route("/stream/<int:id>/", methods=['GET'])
+def stream(id=None):
+    movie = Movie.query.get_or_404(int(id))
+    if not movie.url:
+        abort(404)
+    path = store.local_path(movie.url)
+    if path is None:
+        # 不在本机的存储后端直接跳转到文件地址
+        return redirect(store.url(movie.url))
+    return send_range(path)
@@ -0,0 +1,136 @@
+# coding:utf8
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from app.store import store
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+logger = logging.getLogger(__name__)
+
+# 各种图片的缩略图规格：名称 -> (宽, 高, 是否裁剪)
+# 裁剪为固定尺寸用于列表中定宽定高的封面，不裁剪时按比例缩小到不超过该尺寸
+VARIANTS = {
+    "movie": {
+        "index": (266, 166, True),
+        "small": (131, 83, True),
+    },
+    "preview": {
+        "carousel": (1200, 400, False),
+        "small": (140, 140, False),
+    },
+}
+
+
+# 封面缩略图生成
+# 保存封面后把生成任务交给线程池，不占用请求线程；缩略图生成完成前模板使用原图
+class MediaPipeline(object):
+    def __init__(self, workers=2, quality=85):
+        self.workers = workers
+        self.quality = quality
+        self.variants = VARIANTS
+        self._ready = set()
+        self._pid = None
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.workers = app.config.get("MEDIA_WORKERS", self.workers)
+        self.quality = app.config.get("MEDIA_QUALITY", self.quality)
+        self.variants = app.config.get("MEDIA_VARIANTS", self.variants)
+        app.add_template_global(self.media_url)
+        store.derived("variants/", self.discard)
+
+    # fork 之后在子进程中重新创建线程池
+    def _executor(self):
+        with self._lock:
+            if self._pool is None or self._pid != os.getpid():
+                self._pool = ThreadPoolExecutor(max_workers=self.workers)
+                self._pid = os.getpid()
+            return self._pool
+
+    # 同一封面可以同时被电影和预告引用，路径中包含种类，不同种类的同名缩略图互不覆盖
+    def variant_name(self, filename, kind, variant):
+        return "variants/%s/%s/%s.jpg" % (kind, variant, os.path.splitext(filename)[0])
+
+    def submit(self, filename, kind):
+        if Image is None or not filename:
+            return None
+        return self._executor().submit(self._generate, filename, kind)
+
+    def _generate(self, filename, kind):
+        try:
+            self.generate(filename, kind)
+        except Exception:
+            logger.exception("generate variants for %s failed", filename)
+
+    # 生成 filename 的全部缩略图，先写临时文件再移入存储，读取方不会看到写了一半的图片
+    def generate(self, filename, kind):
+        with store.backend.open(filename) as f:
+            src = Image.open(f)
+            src.load()
+        if src.mode not in ("RGB", "L"):
+            src = src.convert("RGB")
+        for variant, (width, height, crop) in self.variants.get(kind, {}).items():
+            if crop:
+                img = ImageOps.fit(src, (width, height), Image.LANCZOS)
+            else:
+                img = src.copy()
+                img.thumbnail((width, height), Image.LANCZOS)
+            name = self.variant_name(filename, kind, variant)
+            fd, tmp = store.mkstemp(".jpg")
+            os.close(fd)
+            try:
+                img.save(tmp, "JPEG", quality=self.quality, optimize=True)
+                os.chmod(tmp, 0o644)
+                store.backend.save(tmp, name)
+            except Exception:
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+                raise
+            self._ready.add(name)
+
+    # 删除 filename 的全部缩略图
+    def discard(self, filename):
+        names = set()
+        for kind, variants in self.variants.items():
+            names.update(self.variant_name(filename, kind, v) for v in variants)
+        self._delete(names)
+        self.discard_legacy(filename)
+
+    # 删除旧版本生成的路径中不含种类的缩略图 variants/<variant>/<stem>.jpg
+    def discard_legacy(self, filename):
+        stem = os.path.splitext(filename)[0]
+        self._delete(set(
+            "variants/%s/%s.jpg" % (v, stem) for variants in self.variants.values() for v in variants
+        ))
+
+    def _delete(self, names):
+        for name in names:
+            store.backend.delete(name)
+            self._ready.discard(name)
+
+    def ready(self, name):
+        if name in self._ready:
+            return True
+        if store.backend.exists(name):
+            self._ready.add(name)
+            return True
+        return False
+
+    # 模板中使用：缩略图已生成时返回缩略图地址，否则返回原图地址
+    def media_url(self, filename, kind, variant):
+        if not filename:
+            return ""
+        name = self.variant_name(filename, kind, variant)
+        if self.ready(name):
+            return store.url(name)
+        return store.url(filename)
+
+
+media = MediaPipeline()
@@ -13,7 +13,7 @@ class User(db.Model):
     email = db.Column(db.String(100), unique=True)
     phone = db.Column(db.String(11), unique=True)
     info = db.Column(db.Text)
-    face = db.Column(db.String(255), unique=True)
+    face = db.Column(db.String(255), index=True)
     addtime = db.Column(db.String(100), index=True, default=datetime.now)
     uuid = db.Column(db.String(255), unique=True)
     userlogs = db.relationship('Userlog', backref='user')  # 会员日志外键关联
@@ -24,8 +24,8 @@ class User(db.Model):
         return '<User %r>' % self.name
 
     def check_pwd(self, pwd):
-        from werkzeug.security import check_password_hash
-        return check_password_hash(self.pwd, pwd)
+        from app.passwords import password_hasher
+        return password_hasher.verify(self.pwd, pwd)
 
 
 # 会员登录日志
@@ -57,15 +57,30 @@ class Tag(db.Model):
 # 电影
 class Movie(db.Model):
     __tablename__ = "movie"
-    __table_args__ = {'mysql_collate': 'utf8_general_ci'}
+    # 首页按 标签/星级 过滤、按 添加时间/播放量/评论数 排序的组合索引
+    __table_args__ = (
+        db.Index("ix_movie_playnum", "playnum"),
+        db.Index("ix_movie_commentnum", "commentnum"),
+        db.Index("ix_movie_tag_addtime", "tag_id", "addtime"),
+        db.Index("ix_movie_tag_playnum", "tag_id", "playnum"),
+        db.Index("ix_movie_tag_commentnum", "tag_id", "commentnum"),
+        db.Index("ix_movie_star_addtime", "star", "addtime"),
+        db.Index("ix_movie_star_playnum", "star", "playnum"),
+        db.Index("ix_movie_star_commentnum", "star", "commentnum"),
+        db.Index("ix_movie_tag_star_addtime", "tag_id", "star", "addtime"),
+        db.Index("ix_movie_tag_star_playnum", "tag_id", "star", "playnum"),
+        db.Index("ix_movie_tag_star_commentnum", "tag_id", "star", "commentnum"),
+        {'mysql_collate': 'utf8_general_ci'}
+    )
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(255), unique=True)
-    url = db.Column(db.String(255), unique=True)
-    info = db.Column(db.Text)
-    logo = db.Column(db.String(255), unique=True)
+    url = db.Column(db.String(255), index=True)
+    info = db.deferred(db.Column(db.Text))  # 富文本简介可能很大，只在需要时加载
+    logo = db.Column(db.String(255), index=True)
     star = db.Column(db.SmallInteger)
-    playnum = db.Column(db.BigInteger)
-    commentnum = db.Column(db.BigInteger)
+    # 作为分页的排序键，不允许为空，否则以空值结尾的一页生成的游标无法继续翻页
+    playnum = db.Column(db.BigInteger, nullable=False, default=0, server_default="0")
+    commentnum = db.Column(db.BigInteger, nullable=False, default=0, server_default="0")
     tag_id = db.Column(db.Integer, db.ForeignKey('tag.id'))  # 所属标签
     area = db.Column(db.String(255))
     release_time = db.Column(db.Date)
@@ -84,7 +99,7 @@ class Preview(db.Model):
     __table_args__ = {'mysql_collate': 'utf8_general_ci'}
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(255), unique=True)
-    logo = db.Column(db.String(255), unique=True)
+    logo = db.Column(db.String(255), index=True)
     addtime = db.Column(db.DateTime, index=True, default=datetime.now)
 
     def __repr__(self):
@@ -162,8 +177,8 @@ class Admin(db.Model):
         return "<Admin %r>" % self.name
 
     def check_pwd(self, pwd):
-        from werkzeug.security import check_password_hash
-        return check_password_hash(self.pwd, pwd)
+        from app.passwords import password_hasher
+        return password_hasher.verify(self.pwd, pwd)
 
 
 # 管理员登录日志
@@ -193,5 +208,19 @@ class Oplog(db.Model):
         return "<Adminlog %r>" % self.id
 
 
+# 上传文件，以内容摘要命名，refcount 为被电影、预告、会员头像引用的次数
+class Upfile(db.Model):
+    __tablename__ = "upfile"
+    __table_args__ = {'mysql_collate': 'utf8_general_ci'}
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(255), unique=True)  # 相对于上传目录的路径
+    size = db.Column(db.BigInteger)
+    refcount = db.Column(db.Integer, index=True, default=0)
+    addtime = db.Column(db.DateTime, index=True, default=datetime.now)
+
+    def __repr__(self):
+        return "<Upfile %r>" % self.name
+
+
 if __name__ == "__main__":
     db.create_all()
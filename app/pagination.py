@@ -0,0 +1,244 @@
+# coding:utf8
+import datetime
+import threading
+import time
+from flask import abort, current_app, request
+from flask_sqlalchemy import Pagination
+from itsdangerous import URLSafeSerializer, BadSignature
+from sqlalchemy import and_, or_, event, text
+from sqlalchemy.orm import Session
+from sqlalchemy.sql.util import find_tables
+
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S.%f"
+
+
+# 校验页码，超过 MAX_PAGE 的深分页直接返回404
+def check_page(page):
+    if page is None:
+        page = 1
+    if page < 1 or page > current_app.config.get("MAX_PAGE", 1000):
+        abort(404)
+    return page
+
+
+def _serializer():
+    return URLSafeSerializer(current_app.config["SECRET_KEY"], salt="page-cursor")
+
+
+def _dump_value(value):
+    if isinstance(value, datetime.datetime):
+        return ["t", value.strftime(TIME_FORMAT)]
+    if isinstance(value, datetime.date):
+        return ["d", value.strftime("%Y-%m-%d")]
+    return ["v", value]
+
+
+def _load_value(value):
+    kind, value = value
+    if kind == "t":
+        return datetime.datetime.strptime(value, TIME_FORMAT)
+    if kind == "d":
+        return datetime.datetime.strptime(value, "%Y-%m-%d").date()
+    return value
+
+
+# 生成游标：方向(n下一页/p上一页) + 排序键的值
+def encode_cursor(direction, values):
+    return _serializer().dumps([direction, [_dump_value(v) for v in values]])
+
+
+def decode_cursor(token):
+    try:
+        direction, values = _serializer().loads(token)
+        return direction, [_load_value(v) for v in values]
+    except (BadSignature, ValueError, TypeError):
+        abort(404)
+
+
+# 排序键：[(列, 是否倒序), ...]，最后一个总是主键
+def keyset_keys(query, order):
+    entity = query.column_descriptions[0]["entity"]
+    order = list(order)
+    last_desc = order[-1][1] == "desc" if order else False
+    keys = [(col, how == "desc") for col, how in order]
+    if not keys or keys[-1][0] is not entity.id:
+        keys.append((entity.id, last_desc))
+    return keys
+
+
+def keyset_order_by(keys, forward=True):
+    return [
+        col.desc() if desc == forward else col.asc()
+        for col, desc in keys
+    ]
+
+
+# 游标分页
+# order 为 [(列, 'desc'|'asc'), ...]，自动追加主键作为最后一个排序键，
+# 翻页时按 (排序键, id) 定位而不是 OFFSET，深分页与第一页代价相同
+class KeysetPagination(object):
+    def __init__(self, query, order, page=1, cursor=None, per_page=10):
+        self.keys = keyset_keys(query, order)
+        self.page = page
+        self.per_page = per_page
+
+        direction, values = "n", None
+        if cursor:
+            direction, values = decode_cursor(cursor)
+            if len(values) != len(self.keys):
+                abort(404)
+        forward = direction == "n"
+
+        q = query
+        if values is not None:
+            q = q.filter(self._seek(values, forward))
+        q = q.order_by(*self._order(forward))
+        if values is None and page > 1:
+            # 没有游标时兼容旧的页码链接，页码已由 check_page 限制
+            q = q.offset((page - 1) * per_page)
+        rows = q.limit(per_page + 1).all()
+        more = len(rows) > per_page
+        rows = rows[:per_page]
+        if forward:
+            self.items = rows
+            self.has_prev = values is not None or page > 1
+            self.has_next = more
+        else:
+            rows.reverse()
+            self.items = rows
+            self.has_prev = more
+            self.has_next = True
+            if not more:
+                self.page = 1
+
+    def _order(self, forward):
+        return keyset_order_by(self.keys, forward)
+
+    # (k1, k2, ..., id) 的字典序比较展开为 OR 条件
+    def _seek(self, values, forward):
+        clauses = []
+        for i, (col, desc) in enumerate(self.keys):
+            before = [self.keys[j][0] == values[j] for j in range(i)]
+            if desc == forward:
+                before.append(col < values[i])
+            else:
+                before.append(col > values[i])
+            clauses.append(and_(*before))
+        return or_(*clauses)
+
+    def _values(self, item):
+        return [getattr(item, col.key) for col, desc in self.keys]
+
+    @property
+    def prev_num(self):
+        return max(self.page - 1, 1)
+
+    @property
+    def next_num(self):
+        return self.page + 1
+
+    @property
+    def prev_cursor(self):
+        if not self.items or not self.has_prev:
+            return None
+        return encode_cursor("p", self._values(self.items[0]))
+
+    @property
+    def next_cursor(self):
+        if not self.items or not self.has_next:
+            return None
+        return encode_cursor("n", self._values(self.items[-1]))
+
+
+# 带游标的请求不使用 OFFSET，页码只用于显示，不受 MAX_PAGE 限制
+def keyset_paginate(query, order, page=None, per_page=10):
+    cursor = request.args.get("cursor")
+    page = max(page or 1, 1) if cursor else check_page(page)
+    return KeysetPagination(query, order, page=page, cursor=cursor, per_page=per_page)
+
+
+# 总数缓存
+# 按 (查询语句, 参数) 缓存 COUNT(*) 结果，TTL 过期或相关表有写入时失效；
+# 无过滤条件的大表可以直接使用 information_schema 中的估算行数
+class CountCache(object):
+    def __init__(self, ttl=60, estimate_min=100000):
+        self.ttl = ttl
+        self.estimate_min = estimate_min
+        self._lock = threading.Lock()
+        self._data = {}
+        self._tables = {}
+
+    def init_app(self, app):
+        self.ttl = app.config.get("COUNT_CACHE_TTL", self.ttl)
+        self.estimate_min = app.config.get("COUNT_ESTIMATE_MIN", self.estimate_min)
+        event.listen(Session, "after_flush", self._after_flush)
+
+    def _after_flush(self, session, flush_context):
+        tables = set()
+        for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+            table = getattr(obj, "__tablename__", None)
+            if table:
+                tables.add(table)
+        for table in tables:
+            self.invalidate(table)
+
+    def invalidate(self, table=None):
+        with self._lock:
+            if table is None:
+                self._data.clear()
+                self._tables.clear()
+                return
+            for key in self._tables.pop(table, ()):
+                self._data.pop(key, None)
+
+    def _key(self, query):
+        compiled = query.statement.compile()
+        params = tuple(sorted((k, repr(v)) for k, v in compiled.params.items()))
+        return str(compiled), params
+
+    def count(self, query, estimate=False):
+        key = self._key(query)
+        now = time.time()
+        with self._lock:
+            hit = self._data.get(key)
+        if hit is not None and hit[0] > now:
+            return hit[1]
+        tables = [t.name for t in find_tables(query.statement)]
+        total = None
+        if estimate and len(tables) == 1 and query.whereclause is None:
+            total = self._estimate(query, tables[0])
+        if total is None:
+            total = query.order_by(None).count()
+        with self._lock:
+            self._data[key] = (now + self.ttl, total)
+            for table in tables:
+                self._tables.setdefault(table, set()).add(key)
+        return total
+
+    # MySQL 的表统计行数，小表估算误差大，低于 estimate_min 时返回 None 改用精确计数
+    def _estimate(self, query, table):
+        session = query.session
+        if session.get_bind().dialect.name != "mysql":
+            return None
+        rows = session.execute(
+            text("SELECT TABLE_ROWS FROM information_schema.TABLES "
+                 "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = :name"),
+            {"name": table}
+        ).scalar()
+        if rows is None or rows < self.estimate_min:
+            return None
+        return int(rows)
+
+
+count_cache = CountCache()
+
+
+# 与 Query.paginate 相同，但总数取自 count_cache，不再每次执行 COUNT(*)
+def cached_paginate(query, page=None, per_page=10, estimate=False, total=None):
+    page = check_page(page)
+    if total is None:
+        total = count_cache.count(query, estimate=estimate)
+    items = query.limit(per_page).offset((page - 1) * per_page).all()
+    if not items and page != 1:
+        abort(404)
+    return Pagination(query, page, per_page, total, items)
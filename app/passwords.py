@@ -0,0 +1,117 @@
+# coding:utf8
+import atexit
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from werkzeug.exceptions import ServiceUnavailable
+from werkzeug.security import check_password_hash, generate_password_hash
+
+
+# 等待计算密码哈希的请求过多，返回 503
+class PasswordBusy(ServiceUnavailable):
+    description = "Too many password checks in progress, please try again later."
+
+
+# 密码哈希的计算与校验
+# 在独立的进程池中执行，不占用请求线程所在进程的 CPU 与 GIL；同时进行中（含排队）的任务数不超过
+# max_pending，超出时等待 wait_timeout 秒后返回 503。workers 为 0 时在当前线程中计算。
+# 进程池按 Web 进程分别创建，单机总的计算进程数为 Web 进程数 × workers。计算进程以 spawn 方式启动，
+# 不继承 Web 进程中后台线程持有的锁；计算进程意外退出时丢弃损坏的进程池并重试一次
+class PasswordHasher(object):
+    def __init__(self, method="pbkdf2:sha256", iterations=150000, salt_length=8,
+                 workers=2, max_pending=32, wait_timeout=5, start_method="spawn"):
+        self.method = method
+        self.iterations = iterations
+        self.salt_length = salt_length
+        self.workers = workers
+        self.max_pending = max_pending
+        self.wait_timeout = wait_timeout
+        self.start_method = start_method
+        self._lock = threading.Lock()
+        self._reset()
+        atexit.register(self.shutdown)
+
+    def init_app(self, app):
+        self.method = app.config.get("PASSWORD_HASH_METHOD", self.method)
+        self.iterations = app.config.get("PASSWORD_HASH_ITERATIONS", self.iterations)
+        self.salt_length = app.config.get("PASSWORD_SALT_LENGTH", self.salt_length)
+        self.workers = app.config.get("PASSWORD_WORKERS", self.workers)
+        self.max_pending = app.config.get("PASSWORD_MAX_PENDING", self.max_pending)
+        self.wait_timeout = app.config.get("PASSWORD_WAIT_TIMEOUT", self.wait_timeout)
+        self.start_method = app.config.get("PASSWORD_START_METHOD", self.start_method)
+        self._reset()
+
+    # fork 之后子进程重新创建自己的进程池
+    def _reset(self):
+        self._pid = os.getpid()
+        self._pool = None
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+
+    def _executor(self):
+        if self._pid != os.getpid():
+            self._reset()
+        if self._pool is None:
+            with self._lock:
+                if self._pool is None:
+                    self._pool = ProcessPoolExecutor(
+                        max_workers=self.workers,
+                        mp_context=multiprocessing.get_context(self.start_method)
+                    )
+        return self._pool
+
+    # 丢弃已损坏的进程池，下一次调用 _executor 时重新创建
+    def _discard(self, pool):
+        with self._lock:
+            if self._pool is pool:
+                self._pool = None
+        pool.shutdown(wait=False)
+
+    def _submit(self, f, *args):
+        pool = self._executor()
+        try:
+            return pool.submit(f, *args).result()
+        except BrokenProcessPool:
+            self._discard(pool)
+            return self._executor().submit(f, *args).result()
+
+    def _run(self, f, *args):
+        if self._pid != os.getpid():
+            self._reset()
+        if not self._slots.acquire(timeout=self.wait_timeout):
+            raise PasswordBusy()
+        try:
+            if not self.workers:
+                return f(*args)
+            return self._submit(f, *args)
+        finally:
+            self._slots.release()
+
+    # 当前配置的哈希方法，如 pbkdf2:sha256:150000，与哈希值中记录的方法格式一致
+    def method_name(self):
+        if self.method.startswith("pbkdf2:"):
+            return "%s:%d" % (self.method, self.iterations)
+        return self.method
+
+    def hash(self, password):
+        return self._run(generate_password_hash, password, self.method_name(), self.salt_length)
+
+    def verify(self, pwhash, password):
+        if not pwhash:
+            return False
+        return self._run(check_password_hash, pwhash, password)
+
+    # 哈希值使用的方法或盐长度与当前配置不同时需要重新计算
+    def needs_rehash(self, pwhash):
+        parts = (pwhash or "").split("$")
+        return len(parts) != 3 or parts[0] != self.method_name() or len(parts[1]) != self.salt_length
+
+    def shutdown(self):
+        pool, self._pool = self._pool, None
+        if pool is not None and self._pid == os.getpid():
+            pool.shutdown(wait=False)
+
+
+password_hasher = PasswordHasher()
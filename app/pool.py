@@ -0,0 +1,158 @@
+# coding:utf8
+import os
+import threading
+import time
+
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
+from sqlalchemy.exc import TimeoutError
+from sqlalchemy.pool import Pool, QueuePool
+
+# checkout 等待时间分布的区间上限（秒），最后一格为超过 1 秒
+WAIT_BUCKETS = (0.001, 0.01, 0.1, 1.0)
+
+
+# 连接池统计
+# 记录 checkout 等待时间、使用中的连接数、溢出连接数及连接失效次数，用于根据实际数据调整连接池大小；
+# 每个进程有自己的连接池，统计也按进程分别记录，fork 之后在子进程中重新开始
+class PoolStats(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self.pid = os.getpid()
+        self.started = time.time()
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.wait_buckets = [0] * (len(WAIT_BUCKETS) + 1)
+        self.in_use = 0
+        self.in_use_max = 0
+        self.overflow_max = 0
+        self.connects = 0
+        self.closes = 0
+        self.invalidations = 0
+        self.soft_invalidations = 0
+
+    def init_app(self, app):
+        event.listen(Pool, "connect", self._on_connect)
+        event.listen(Pool, "checkout", self._on_checkout)
+        event.listen(Pool, "checkin", self._on_checkin)
+        event.listen(Pool, "invalidate", self._on_invalidate)
+        event.listen(Pool, "soft_invalidate", self._on_soft_invalidate)
+        event.listen(Pool, "close", self._on_close)
+
+    def _check_pid(self):
+        if self.pid != os.getpid():
+            self._reset()
+
+    def waited(self, seconds, overflow=0, timeout=False):
+        with self._lock:
+            self._check_pid()
+            self.wait_total += seconds
+            self.wait_max = max(self.wait_max, seconds)
+            for i, limit in enumerate(WAIT_BUCKETS):
+                if seconds < limit:
+                    self.wait_buckets[i] += 1
+                    break
+            else:
+                self.wait_buckets[-1] += 1
+            self.overflow_max = max(self.overflow_max, overflow)
+            if timeout:
+                self.timeouts += 1
+
+    def _on_connect(self, dbapi_connection, connection_record):
+        with self._lock:
+            self._check_pid()
+            self.connects += 1
+
+    def _on_checkout(self, dbapi_connection, connection_record, connection_proxy):
+        with self._lock:
+            self._check_pid()
+            self.checkouts += 1
+            self.in_use += 1
+            self.in_use_max = max(self.in_use_max, self.in_use)
+
+    def _on_checkin(self, dbapi_connection, connection_record):
+        with self._lock:
+            self._check_pid()
+            self.in_use = max(self.in_use - 1, 0)
+
+    def _on_invalidate(self, dbapi_connection, connection_record, exception):
+        with self._lock:
+            self._check_pid()
+            self.invalidations += 1
+
+    def _on_soft_invalidate(self, dbapi_connection, connection_record, exception):
+        with self._lock:
+            self._check_pid()
+            self.soft_invalidations += 1
+
+    def _on_close(self, dbapi_connection, connection_record):
+        with self._lock:
+            self._check_pid()
+            self.closes += 1
+
+    # 当前进程的统计数据，pool 为 QueuePool 时附带连接池的实时状态
+    def report(self, pool=None):
+        with self._lock:
+            self._check_pid()
+            waits = sum(self.wait_buckets)
+            data = dict(
+                pid=self.pid,
+                uptime=round(time.time() - self.started, 1),
+                checkouts=self.checkouts,
+                timeouts=self.timeouts,
+                wait_avg_ms=round(self.wait_total * 1000 / waits, 3) if waits else 0,
+                wait_max_ms=round(self.wait_max * 1000, 3),
+                wait_buckets=dict(zip(
+                    ["<%gms" % (v * 1000) for v in WAIT_BUCKETS] + [">=%gms" % (WAIT_BUCKETS[-1] * 1000)],
+                    self.wait_buckets
+                )),
+                in_use=self.in_use,
+                in_use_max=self.in_use_max,
+                overflow_max=self.overflow_max,
+                connects=self.connects,
+                closes=self.closes,
+                invalidations=self.invalidations,
+                soft_invalidations=self.soft_invalidations,
+            )
+        if isinstance(pool, QueuePool):
+            data["pool"] = dict(
+                size=pool.size(),
+                checked_in=pool.checkedin(),
+                checked_out=pool.checkedout(),
+                overflow=max(pool.overflow(), 0),
+                timeout=pool.timeout(),
+            )
+        return data
+
+
+pool_stats = PoolStats()
+
+
+# 记录 checkout 等待时间的 QueuePool，包括连接池已满时排队及新建连接的时间
+class InstrumentedQueuePool(QueuePool):
+    def _do_get(self):
+        start = time.time()
+        try:
+            conn = QueuePool._do_get(self)
+        except TimeoutError:
+            pool_stats.waited(time.time() - start, self.overflow(), timeout=True)
+            raise
+        pool_stats.waited(time.time() - start, self.overflow())
+        return conn
+
+
+# 连接池参数由配置决定：SQLALCHEMY_POOL_SIZE / SQLALCHEMY_MAX_OVERFLOW / SQLALCHEMY_POOL_TIMEOUT /
+# SQLALCHEMY_POOL_RECYCLE 由 Flask-SQLAlchemy 读取，这里补充 SQLALCHEMY_POOL_PRE_PING，
+# 并在使用队列连接池时换成带统计的 InstrumentedQueuePool
+class PooledSQLAlchemy(SQLAlchemy):
+    def apply_driver_hacks(self, app, info, options):
+        rv = super(PooledSQLAlchemy, self).apply_driver_hacks(app, info, options)
+        if "poolclass" not in options:
+            options["poolclass"] = InstrumentedQueuePool
+        options.setdefault("pool_pre_ping", app.config.get("SQLALCHEMY_POOL_PRE_PING", False))
+        return rv
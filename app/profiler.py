@@ -0,0 +1,133 @@
+# coding:utf8
+import collections
+import random
+import re
+import threading
+import time
+
+from flask import g, has_request_context, request, session
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# 语句指纹：去掉参数差异后相同的语句视为同一种查询
+_IN_LIST = re.compile(r"\((\s*(%s|\?|%\(\w+\)s|:\w+)\s*,)+\s*(%s|\?|%\(\w+\)s|:\w+)\s*\)")
+_NUMBER = re.compile(r"\b\d+\b")
+_SPACE = re.compile(r"\s+")
+
+
+def fingerprint(statement):
+    statement = _SPACE.sub(" ", statement.strip())
+    statement = _IN_LIST.sub("(...)", statement)
+    return _NUMBER.sub("?", statement)
+
+
+# 单个端点的累计统计
+class EndpointStats(object):
+    def __init__(self):
+        self.requests = 0
+        self.queries = 0
+        self.time = 0.0
+        self.max_queries = 0
+        self.flagged = 0
+        self.patterns = collections.Counter()  # N+1 指纹 -> 出现的请求数
+        self.repeats = {}  # N+1 指纹 -> 单个请求内的最多重复次数
+
+
+# 按请求采样的 SQL 性能统计
+# 被采样的请求记录执行的语句数、SQL 总耗时及每种语句指纹的重复次数，同一指纹在一个请求中
+# 重复达到 n1_threshold 次时视为 N+1 加载；结果写入响应头 X-SQL-Profile，并按端点累计供后台查看。
+# 未被采样的请求在引擎事件中只做一次 g 的属性检查
+class QueryProfiler(object):
+    def __init__(self, sample=0.01, n1_threshold=5, max_patterns=20):
+        self.sample = sample
+        self.n1_threshold = n1_threshold
+        self.max_patterns = max_patterns
+        self._lock = threading.Lock()
+        self._stats = {}
+        self.started = time.time()
+
+    def init_app(self, app):
+        self.sample = app.config.get("SQL_PROFILE_SAMPLE", self.sample)
+        self.n1_threshold = app.config.get("SQL_PROFILE_N1_THRESHOLD", self.n1_threshold)
+        self.max_patterns = app.config.get("SQL_PROFILE_MAX_PATTERNS", self.max_patterns)
+        event.listen(Engine, "before_cursor_execute", self._before_execute)
+        event.listen(Engine, "after_cursor_execute", self._after_execute)
+        app.before_request(self._start)
+        app.after_request(self._finish)
+
+    # 按比例采样；已登录的管理员可以用 ?_profile=1 强制采样当前请求
+    def _start(self):
+        if random.random() < self.sample or (request.args.get("_profile") == "1" and "admin" in session):
+            g.sql_profile = dict(queries=0, time=0.0, statements=collections.Counter())
+
+    # 开始时间记在本次执行的 context 上，没有 context 的内部语句（如 pre-ping）只计数
+    def _before_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if context is not None and has_request_context() and getattr(g, "sql_profile", None) is not None:
+            context._sql_profile_start = time.time()
+
+    def _after_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if not has_request_context():
+            return
+        profile = getattr(g, "sql_profile", None)
+        if profile is None:
+            return
+        start = getattr(context, "_sql_profile_start", None)
+        profile["queries"] += 1
+        if start is not None:
+            profile["time"] += time.time() - start
+        profile["statements"][fingerprint(statement)] += 1
+
+    def _finish(self, resp):
+        profile = g.pop("sql_profile", None)
+        if profile is None:
+            return resp
+        repeated = [(k, n) for k, n in profile["statements"].items() if n >= self.n1_threshold]
+        resp.headers["X-SQL-Profile"] = "queries=%d; time=%.1fms; n+1=%d" % (
+            profile["queries"], profile["time"] * 1000, len(repeated)
+        )
+        self._record(request.endpoint or "-", profile, repeated)
+        return resp
+
+    def _record(self, endpoint, profile, repeated):
+        with self._lock:
+            stats = self._stats.get(endpoint)
+            if stats is None:
+                stats = self._stats[endpoint] = EndpointStats()
+            stats.requests += 1
+            stats.queries += profile["queries"]
+            stats.time += profile["time"]
+            stats.max_queries = max(stats.max_queries, profile["queries"])
+            if repeated:
+                stats.flagged += 1
+            for key, n in repeated:
+                if key in stats.patterns or len(stats.patterns) < self.max_patterns:
+                    stats.patterns[key] += 1
+                    stats.repeats[key] = max(stats.repeats.get(key, 0), n)
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+            self.started = time.time()
+
+    # 按平均语句数从多到少排列的端点统计
+    def report(self):
+        with self._lock:
+            rows = []
+            for endpoint, v in self._stats.items():
+                rows.append(dict(
+                    endpoint=endpoint,
+                    requests=v.requests,
+                    avg_queries=round(float(v.queries) / v.requests, 1),
+                    max_queries=v.max_queries,
+                    avg_time_ms=round(v.time * 1000 / v.requests, 2),
+                    flagged=v.flagged,
+                    patterns=[
+                        dict(statement=k, requests=n, repeats=v.repeats[k])
+                        for k, n in v.patterns.most_common()
+                    ],
+                ))
+        rows.sort(key=lambda v: v["avg_queries"], reverse=True)
+        return rows
+
+
+sql_profiler = QueryProfiler()
@@ -0,0 +1,228 @@
+# coding:utf8
+import datetime
+import gzip
+import json
+import os
+
+from flask import request
+from sqlalchemy import and_, func, inspect, or_, select, text
+
+
+def month_start(value):
+    return datetime.datetime(value.year, value.month, 1)
+
+
+def add_months(value, n):
+    month = value.year * 12 + value.month - 1 + n
+    return datetime.datetime(month // 12, month % 12 + 1, 1)
+
+
+def _json_value(value):
+    if isinstance(value, datetime.datetime):
+        return value.strftime("%Y-%m-%d %H:%M:%S")
+    return value
+
+
+# 登录日志及操作日志的按月分段保存
+# 日志表按 addtime 以自然月为单位分段：MySQL 上转换为按月的 RANGE 分区，过期的分区整体删除；
+# 其他数据库保持单表，按月分批删除。超过 keep_months 个月的数据先以 gzip 压缩的 JSON Lines
+# 写入 archive_dir 归档再删除，表中只保留最近几个月的数据。列表页面默认只查询最近 hot_days 天
+class LogRetention(object):
+    def __init__(self, db, hot_days=30, keep_months=6, archive_dir=None, batch=5000, ahead=3):
+        self.db = db
+        self.hot_days = hot_days
+        self.keep_months = keep_months
+        self.archive_dir = archive_dir
+        self.batch = batch
+        self.ahead = ahead
+
+    def init_app(self, app):
+        self.hot_days = app.config.get("LOG_HOT_DAYS", self.hot_days)
+        self.keep_months = app.config.get("LOG_KEEP_MONTHS", self.keep_months)
+        self.archive_dir = app.config.get("LOG_ARCHIVE_DIR", self.archive_dir)
+        self.batch = app.config.get("LOG_ARCHIVE_BATCH", self.batch)
+        self.ahead = app.config.get("LOG_PARTITION_AHEAD", self.ahead)
+
+    def tables(self):
+        from app.models import Userlog, Adminlog, Oplog
+        return [Userlog.__table__, Adminlog.__table__, Oplog.__table__]
+
+    # 当前请求是否要求查看历史数据（?history=1）
+    def history(self):
+        return request.args.get("history") == "1"
+
+    # 列表查询只保留热数据窗口，history 为真时不限制
+    def hot(self, query, column, history=False):
+        if history:
+            return query
+        return query.filter(column >= datetime.datetime.now() - datetime.timedelta(days=self.hot_days))
+
+    def _quote(self, name):
+        return self.db.engine.dialect.identifier_preparer.quote(name)
+
+    # 表的分区名列表（按顺序），未分区或不是 MySQL 时返回空列表
+    def partitions(self, table):
+        if self.db.engine.dialect.name != "mysql":
+            return []
+        with self.db.engine.connect() as conn:
+            rows = conn.execute(text(
+                "SELECT PARTITION_NAME FROM information_schema.PARTITIONS "
+                "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = :name AND PARTITION_NAME IS NOT NULL "
+                "ORDER BY PARTITION_ORDINAL_POSITION"
+            ), dict(name=table.name)).fetchall()
+        return [v[0] for v in rows]
+
+    def _partition_sql(self, months):
+        parts = ["PARTITION p%s VALUES LESS THAN (TO_DAYS('%s'))" % (
+            v.strftime("%Y%m"), add_months(v, 1).strftime("%Y-%m-%d")
+        ) for v in months]
+        parts.append("PARTITION pmax VALUES LESS THAN MAXVALUE")
+        return "(%s)" % ", ".join(parts)
+
+    def _months(self, start, end):
+        while start <= end:
+            yield start
+            start = add_months(start, 1)
+
+    # 把日志表转换为按月分区，返回是否做了转换
+    # MySQL 分区表不支持外键，且主键必须包含分区字段，转换时删除外键并把主键改为 (id, addtime)
+    def partition(self, table):
+        if self.db.engine.dialect.name != "mysql" or self.partitions(table):
+            return False
+        name = self._quote(table.name)
+        now = datetime.datetime.now()
+        with self.db.engine.connect() as conn:
+            first = conn.execute(select([func.min(table.c.addtime)])).scalar() or now
+        months = list(self._months(month_start(first), add_months(month_start(now), self.ahead)))
+        with self.db.engine.begin() as conn:
+            for fk in inspect(conn).get_foreign_keys(table.name):
+                conn.execute(text("ALTER TABLE %s DROP FOREIGN KEY %s" % (name, self._quote(fk["name"]))))
+            # 分区字段不能为空，旧数据中缺少时间的按转换时间记
+            conn.execute(table.update().where(table.c.addtime.is_(None)).values(addtime=now))
+            conn.execute(text(
+                "ALTER TABLE %s MODIFY addtime DATETIME NOT NULL, DROP PRIMARY KEY, ADD PRIMARY KEY (id, addtime)" % name
+            ))
+            conn.execute(text(
+                "ALTER TABLE %s PARTITION BY RANGE (TO_DAYS(addtime)) %s" % (name, self._partition_sql(months))
+            ))
+        return True
+
+    # 从 pmax 中拆分出未来 ahead 个月的分区，返回新增的分区数
+    def extend(self, table):
+        names = [v for v in self.partitions(table) if v != "pmax"]
+        if not names:
+            return 0
+        last = datetime.datetime.strptime(names[-1][1:], "%Y%m")
+        months = list(self._months(add_months(last, 1), add_months(month_start(datetime.datetime.now()), self.ahead)))
+        if months:
+            with self.db.engine.begin() as conn:
+                conn.execute(text("ALTER TABLE %s REORGANIZE PARTITION pmax INTO %s" % (
+                    self._quote(table.name), self._partition_sql(months)
+                )))
+        return len(months)
+
+    # 已过保留期的月份：[(下界, 上界, 分区名)]，第一个分区包含其上界之前的全部数据，下界为 None
+    def expired(self, table):
+        cutoff = add_months(month_start(datetime.datetime.now()), -self.keep_months)
+        names = self.partitions(table)
+        buckets = []
+        if names:
+            for i, name in enumerate(names):
+                if name == "pmax":
+                    continue
+                start = datetime.datetime.strptime(name[1:], "%Y%m")
+                if add_months(start, 1) <= cutoff:
+                    buckets.append((None if i == 0 else start, add_months(start, 1), name))
+            return buckets
+        with self.db.engine.connect() as conn:
+            first = conn.execute(select([func.min(table.c.addtime)])).scalar()
+        if first is not None:
+            for start in self._months(month_start(first), add_months(cutoff, -1)):
+                buckets.append((start, add_months(start, 1), None))
+        return buckets
+
+    def _range(self, table, lower, upper):
+        cond = table.c.addtime < upper
+        if lower is not None:
+            cond = and_(table.c.addtime >= lower, cond)
+        return cond
+
+    # 按 (addtime, id) 分批读取一个月的数据，内存占用与数据量无关
+    def _stream(self, table, lower, upper):
+        cond = self._range(table, lower, upper)
+        last = None
+        while True:
+            query = select([table]).where(cond)
+            if last is not None:
+                query = query.where(or_(
+                    table.c.addtime > last[0],
+                    and_(table.c.addtime == last[0], table.c.id > last[1])
+                ))
+            with self.db.engine.connect() as conn:
+                rows = conn.execute(query.order_by(table.c.addtime, table.c.id).limit(self.batch)).fetchall()
+            if not rows:
+                return
+            for row in rows:
+                yield row
+            last = (rows[-1].addtime, rows[-1].id)
+
+    # 归档文件路径，同一个月已经归档过（如上次删除中途失败）时另起一个文件，不覆盖已有的归档
+    def _archive_path(self, table, month):
+        directory = os.path.join(self.archive_dir, table.name)
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        base = os.path.join(directory, "%s-%s" % (table.name, month.strftime("%Y%m")))
+        path, n = base + ".jsonl.gz", 1
+        while os.path.exists(path):
+            n += 1
+            path = "%s.%d.jsonl.gz" % (base, n)
+        return path
+
+    # 把一个月的数据写入归档文件，先写临时文件再改名，返回 (文件路径, 行数)，没有数据时不生成文件
+    def archive(self, table, lower, upper):
+        path = self._archive_path(table, add_months(upper, -1))
+        keys = table.columns.keys()
+        count = 0
+        with gzip.open(path + ".tmp", "wt", encoding="utf8") as f:
+            for row in self._stream(table, lower, upper):
+                f.write(json.dumps(dict((k, _json_value(v)) for k, v in zip(keys, row)), ensure_ascii=False))
+                f.write("\n")
+                count += 1
+        if not count:
+            os.remove(path + ".tmp")
+            return None, 0
+        os.rename(path + ".tmp", path)
+        return path, count
+
+    # 删除已归档的数据：有分区时删除整个分区，否则按主键分批删除
+    def drop(self, table, lower, upper, partition=None):
+        if partition is not None:
+            with self.db.engine.begin() as conn:
+                conn.execute(text("ALTER TABLE %s DROP PARTITION %s" % (
+                    self._quote(table.name), self._quote(partition)
+                )))
+            return
+        cond = self._range(table, lower, upper)
+        while True:
+            with self.db.engine.begin() as conn:
+                ids = [v[0] for v in conn.execute(
+                    select([table.c.id]).where(cond).order_by(table.c.id).limit(self.batch)
+                ).fetchall()]
+                if not ids:
+                    return
+                conn.execute(table.delete().where(table.c.id.in_(ids)))
+
+    # 补充未来的分区，归档并删除过期的月份，返回 [(分区名或月份, 归档文件, 行数)]
+    def rotate(self, table, dry_run=False):
+        done = []
+        if not dry_run:
+            self.extend(table)
+        for lower, upper, partition in self.expired(table):
+            label = partition or add_months(upper, -1).strftime("%Y%m")
+            if dry_run:
+                done.append((label, None, None))
+                continue
+            path, count = self.archive(table, lower, upper)
+            self.drop(table, lower, upper, partition)
+            done.append((label, path, count))
+        return done
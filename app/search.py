@@ -0,0 +1,133 @@
+# coding:utf8
+import os
+import tempfile
+import threading
+import time
+
+
+# 切分为单字及相邻两字的片段，中文片名没有空格也可以检索
+def ngrams(text):
+    text = text.lower()
+    grams = set(text)
+    grams.update(text[i:i + 2] for i in range(len(text) - 1))
+    return grams
+
+
+# 电影片名倒排索引
+# 每个进程在内存中维护一份，后台增删改时就地更新并修改标记文件，
+# 其他进程在下一次检索时发现标记文件变化后重新构建
+class TitleIndex(object):
+    def __init__(self, stamp=None):
+        self.stamp = stamp or os.path.join(tempfile.gettempdir(), "movie-search-index.stamp")
+        self._lock = threading.RLock()
+        self._postings = {}
+        self._docs = {}
+        self._built = None
+
+    def init_app(self, app):
+        self.stamp = app.config.get("SEARCH_INDEX_STAMP", self.stamp)
+
+    def _stamp_mtime(self):
+        try:
+            return os.stat(self.stamp).st_mtime
+        except OSError:
+            return 0
+
+    def _touch(self):
+        with open(self.stamp, "a"):
+            os.utime(self.stamp, None)
+        return self._stamp_mtime()
+
+    # 从数据库全量构建，只读取 id、片名、添加时间
+    def rebuild(self, notify=False):
+        from app.models import Movie
+        from app import db
+        # 先取标记时间再读数据，读取期间的写入会让标记时间更新，下一次检索时再次重建
+        mtime = self._touch() if notify else self._stamp_mtime()
+        rows = db.session.query(Movie.id, Movie.title, Movie.addtime).all()
+        postings = {}
+        docs = {}
+        for movie_id, title, addtime in rows:
+            title = title or ""
+            docs[movie_id] = (title.lower(), addtime)
+            for gram in ngrams(title):
+                postings.setdefault(gram, set()).add(movie_id)
+        with self._lock:
+            self._postings = postings
+            self._docs = docs
+            self._built = mtime
+        return len(docs)
+
+    def _ensure(self):
+        if self._built is None or self._stamp_mtime() > self._built:
+            self.rebuild()
+
+    def _remove(self, movie_id):
+        doc = self._docs.pop(movie_id, None)
+        if doc is None:
+            return
+        for gram in ngrams(doc[0]):
+            ids = self._postings.get(gram)
+            if ids is not None:
+                ids.discard(movie_id)
+                if not ids:
+                    del self._postings[gram]
+
+    # 本进程的索引是否包含了其他进程的全部写入
+    def _current(self):
+        return self._built is not None and self._stamp_mtime() <= self._built
+
+    # 新增或修改电影后增量更新并修改标记文件，通知其他进程重建；
+    # 本进程的索引尚未构建或已落后于其他进程时只修改标记文件，下一次检索时重建
+    def update(self, movie):
+        with self._lock:
+            current = self._current()
+            if current:
+                self._remove(movie.id)
+                title = movie.title or ""
+                self._docs[movie.id] = (title.lower(), movie.addtime)
+                for gram in ngrams(title):
+                    self._postings.setdefault(gram, set()).add(movie.id)
+            mtime = self._touch()
+            if current:
+                self._built = mtime
+
+    # 删除电影后增量更新
+    def delete(self, movie_id):
+        with self._lock:
+            current = self._current()
+            if current:
+                self._remove(movie_id)
+            mtime = self._touch()
+            if current:
+                self._built = mtime
+
+    # 返回 (当前页的电影id列表, 总数)
+    # 排序：片名完全相同 > 前缀匹配 > 匹配位置靠前 > 添加时间新
+    def search(self, key, page=1, per_page=10):
+        self._ensure()
+        key = (key or "").strip().lower()
+        with self._lock:
+            if not key:
+                ids = list(self._docs)
+            else:
+                grams = [key] if len(key) == 1 else [key[i:i + 2] for i in range(len(key) - 1)]
+                postings = sorted((self._postings.get(g, set()) for g in set(grams)), key=len)
+                ids = set(postings[0]).intersection(*postings[1:]) if postings else set()
+                # 片段命中不代表连续出现，再用子串匹配确认，与 LIKE '%key%' 的结果一致
+                ids = [v for v in ids if key in self._docs[v][0]]
+            docs = self._docs
+
+            def rank(movie_id):
+                title, addtime = docs[movie_id]
+                ts = time.mktime(addtime.timetuple()) if addtime else 0
+                if not key:
+                    return (0, 0, -ts, -movie_id)
+                return (0 if title == key else 1 if title.startswith(key) else 2, title.find(key), -ts, -movie_id)
+
+            ids.sort(key=rank)
+        start = (page - 1) * per_page
+        return ids[start:start + per_page], len(ids)
+
+
+title_index = TitleIndex()
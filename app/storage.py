@@ -0,0 +1,182 @@
+# coding:utf8
+import hashlib
+import itertools
+import os
+import posixpath
+import re
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import url_for
+
+DIGEST_NAME = re.compile(r"^[0-9a-f]{64}(\.[a-z0-9]+)?$")
+SHARD_NAME = re.compile(r"^[0-9a-f]{2}$")
+
+
+# 上传文件存储后端
+# name 为数据库中记录的逻辑文件名（含子目录，如 users/<摘要>.png），
+# 文件实际保存在哪里、以什么地址访问由后端决定
+class Storage(object):
+    def init_app(self, app):
+        pass
+
+    # 把本地文件 src 移入存储，保存为 name
+    def save(self, src, name):
+        raise NotImplementedError
+
+    def open(self, name):
+        raise NotImplementedError
+
+    def exists(self, name):
+        raise NotImplementedError
+
+    def delete(self, name):
+        raise NotImplementedError
+
+    # 刷新文件的修改时间
+    def touch(self, name):
+        raise NotImplementedError
+
+    def mtime(self, name):
+        raise NotImplementedError
+
+    # 遍历存储中的全部文件，返回 (逻辑文件名, 修改时间, 大小)，顺序不定
+    def iter_files(self):
+        raise NotImplementedError
+
+    # 浏览器访问该文件的地址
+    def url(self, name):
+        raise NotImplementedError
+
+    # 文件在本机磁盘上的路径，不在本机的后端返回 None
+    def local_path(self, name):
+        return None
+
+
+# 本地文件系统存储
+# 文件按名称的哈希前缀分散到多级子目录：<子目录>/ab/cd/<文件名>，以摘要命名的文件直接取
+# 摘要的前几位，旧文件名取其 md5。迁移完成前，未分散的旧文件仍从原位置读取
+class LocalStorage(Storage):
+    def __init__(self, root=None, depth=2):
+        self.root = root
+        self.depth = depth
+        self.static_prefix = "uploads/"
+
+    def init_app(self, app):
+        self.root = app.config.get("UP_DIR", self.root)
+        self.depth = app.config.get("STORAGE_SHARD_DEPTH", self.depth)
+        self.static_prefix = os.path.relpath(self.root, app.static_folder).replace(os.sep, "/") + "/"
+
+    def shard(self, name):
+        folder, filename = posixpath.split(name)
+        key = filename if DIGEST_NAME.match(filename) else hashlib.md5(filename.encode("utf8")).hexdigest()
+        parts = [key[i * 2:i * 2 + 2] for i in range(self.depth)]
+        return posixpath.join(folder, *(parts + [filename]))
+
+    # 文件当前所在的相对路径，先找分散后的位置，再找迁移前的位置
+    def locate(self, name):
+        for rel in (self.shard(name), name):
+            if os.path.isfile(os.path.join(self.root, rel)):
+                return rel
+        return None
+
+    def local_path(self, name):
+        return os.path.join(self.root, self.locate(name) or self.shard(name))
+
+    def save(self, src, name):
+        dest = os.path.join(self.root, self.shard(name))
+        directory = os.path.dirname(dest)
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        try:
+            os.rename(src, dest)
+        except OSError:
+            # 跨文件系统时先复制到目标目录再改名，读取方不会看到写了一半的文件
+            fd, tmp = tempfile.mkstemp(suffix=".tmp", dir=directory)
+            os.close(fd)
+            shutil.copyfile(src, tmp)
+            os.chmod(tmp, 0o644)
+            os.rename(tmp, dest)
+            os.remove(src)
+
+    def open(self, name):
+        return open(self.local_path(name), "rb")
+
+    def exists(self, name):
+        return self.locate(name) is not None
+
+    def delete(self, name):
+        for rel in (self.shard(name), name):
+            try:
+                os.remove(os.path.join(self.root, rel))
+            except OSError:
+                pass
+
+    def touch(self, name):
+        os.utime(self.local_path(name), None)
+
+    def mtime(self, name):
+        return os.path.getmtime(self.local_path(name))
+
+    # folder 为逻辑子目录，rel 为实际的相对目录，分散目录不计入逻辑文件名
+    def iter_files(self, folder="", rel=""):
+        for entry in os.scandir(os.path.join(self.root, rel)):
+            if entry.is_dir(follow_symlinks=False):
+                sub = folder if SHARD_NAME.match(entry.name) else folder + entry.name + "/"
+                for v in self.iter_files(sub, rel + entry.name + "/"):
+                    yield v
+            elif entry.is_file(follow_symlinks=False):
+                stat = entry.stat(follow_symlinks=False)
+                yield folder + entry.name, stat.st_mtime, stat.st_size
+
+    def url(self, name):
+        return url_for("static", filename=self.static_prefix + (self.locate(name) or self.shard(name)))
+
+    # 遍历尚未分散存放的文件，返回其逻辑文件名；跳过分散目录及临时文件
+    def _unsharded(self, folder=""):
+        for entry in os.scandir(os.path.join(self.root, folder)):
+            if entry.is_dir(follow_symlinks=False):
+                if not SHARD_NAME.match(entry.name):
+                    for name in self._unsharded(folder + entry.name + "/"):
+                        yield name
+            elif entry.is_file(follow_symlinks=False) and not entry.name.endswith(".tmp"):
+                yield folder + entry.name
+
+    def _migrate_one(self, name):
+        src = os.path.join(self.root, name)
+        dest = os.path.join(self.root, self.shard(name))
+        directory = os.path.dirname(dest)
+        if not os.path.exists(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                if not os.path.isdir(directory):
+                    raise
+        # 先建硬链接再删除原文件，迁移过程中两个位置至少有一个可以访问
+        if not os.path.exists(dest):
+            os.link(src, dest)
+        os.remove(src)
+
+    # 把旧的平铺目录迁移为分散目录，可以在网站运行时执行，返回迁移的文件数
+    def migrate(self, workers=8, batch=1000, log=None):
+        moved = 0
+        names = self._unsharded()
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            while True:
+                chunk = list(itertools.islice(names, batch))
+                if not chunk:
+                    break
+                for name, error in zip(chunk, pool.map(self._try_migrate, chunk)):
+                    if error is None:
+                        moved += 1
+                    elif log is not None:
+                        log("skip %s: %s" % (name, error))
+        return moved
+
+    def _try_migrate(self, name):
+        try:
+            self._migrate_one(name)
+        except OSError as e:
+            return e
+        return None
@@ -0,0 +1,278 @@
+# coding:utf8
+import collections
+import hashlib
+import itertools
+import os
+import tempfile
+
+from flask import request
+from sqlalchemy import event, func, select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session, attributes
+from werkzeug.utils import import_string, secure_filename
+
+from app.storage import DIGEST_NAME, LocalStorage
+
+BLOCK_SIZE = 64 * 1024
+
+
+# 分块摘要：每 chunk_size 字节计算一个 sha256，再对所有分块摘要拼接后计算 sha256
+# 与分块上传完成时的校验值算法一致，分块上传的文件认领时不必重新读取
+class TreeHash(object):
+    def __init__(self, chunk_size):
+        self.chunk_size = chunk_size
+        self._sums = hashlib.sha256()
+        self._chunk = hashlib.sha256()
+        self._filled = 0
+        self._count = 0
+
+    def update(self, data):
+        while data:
+            n = min(len(data), self.chunk_size - self._filled)
+            self._chunk.update(data[:n])
+            self._filled += n
+            data = data[n:]
+            if self._filled == self.chunk_size:
+                self._sums.update(self._chunk.digest())
+                self._chunk = hashlib.sha256()
+                self._filled = 0
+                self._count += 1
+
+    def hexdigest(self):
+        sums = self._sums.copy()
+        if self._filled or not self._count:
+            sums.update(self._chunk.digest())
+        return sums.hexdigest()
+
+
+# 按内容寻址的上传文件存储
+# 文件边上传边计算摘要，以 摘要+扩展名 命名，相同内容只保存一份；文件名即是内容的摘要，
+# 可以作为永不变化的地址长期缓存。Upfile 表记录每个文件被 Movie.url / Movie.logo /
+# Preview.logo / User.face 引用的次数，在会话 flush 时根据字段的修改历史增减。
+# 文件的实际存放由 backend 负责，见 app.storage
+class ContentStore(object):
+    def __init__(self, tmp_dir=None, chunk_size=8 * 1024 * 1024, max_age=365 * 24 * 3600):
+        self.tmp_dir = tmp_dir
+        self.chunk_size = chunk_size
+        self.max_age = max_age
+        self.backend = LocalStorage()
+        self._references = None
+        self._derived = []
+
+    def init_app(self, app):
+        self.tmp_dir = app.config.get("UPLOAD_TMP_DIR", self.tmp_dir)
+        self.chunk_size = app.config.get("UPLOAD_CHUNK_SIZE", self.chunk_size)
+        self.max_age = app.config.get("UPLOAD_MAX_AGE", self.max_age)
+        backend = app.config.get("STORAGE_BACKEND")
+        if backend is not None:
+            self.backend = import_string(backend)() if isinstance(backend, str) else backend
+        self.backend.init_app(app)
+        event.listen(Session, "before_flush", self._before_flush)
+        app.after_request(self._immutable)
+        app.add_template_global(self.url, "upload_url")
+
+    # 引用上传文件的字段：模型 -> ((字段, 文件所在的子目录), ...)
+    def references(self):
+        if self._references is None:
+            from app.models import Movie, Preview, User
+            self._references = {
+                Movie: (("url", ""), ("logo", "")),
+                Preview: (("logo", ""),),
+                User: (("face", "users/"),),
+            }
+        return self._references
+
+    # 模板中使用：上传文件的访问地址，代替手工拼接的 'uploads/' + 文件名
+    def url(self, filename, folder=""):
+        if not filename:
+            return ""
+        return self.backend.url(folder + filename)
+
+    def local_path(self, filename, folder=""):
+        return self.backend.local_path(folder + filename)
+
+    # 登记由其他文件派生出的文件（如缩略图）所在的子目录
+    # 回收时跳过该目录，删除源文件时调用 discard(源文件名) 一并删除派生文件
+    def derived(self, folder, discard):
+        self._derived.append((folder, discard))
+
+    def mkstemp(self, suffix=".tmp"):
+        if not os.path.exists(self.tmp_dir):
+            os.makedirs(self.tmp_dir)
+        return tempfile.mkstemp(suffix=suffix, dir=self.tmp_dir)
+
+    @staticmethod
+    def _ext(filename):
+        return os.path.splitext(secure_filename(filename))[1].lower()
+
+    def _hash_file(self, path):
+        digest = TreeHash(self.chunk_size)
+        with open(path, "rb") as f:
+            for data in iter(lambda: f.read(BLOCK_SIZE), b""):
+                digest.update(data)
+        return digest.hexdigest()
+
+    # 保存上传的 FileStorage，返回以摘要命名的文件名
+    def save(self, storage, folder=""):
+        digest = TreeHash(self.chunk_size)
+        size = 0
+        fd, tmp = self.mkstemp()
+        try:
+            with os.fdopen(fd, "wb") as f:
+                for data in iter(lambda: storage.stream.read(BLOCK_SIZE), b""):
+                    digest.update(data)
+                    f.write(data)
+                    size += len(data)
+            os.chmod(tmp, 0o644)
+            return self._commit(tmp, digest.hexdigest() + self._ext(storage.filename), folder, size)
+        except Exception:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+    # 保存已经在磁盘上的文件（如分块上传的结果），源文件会被移走
+    # digest 为按 chunk_size 计算的分块摘要，分块大小与本存储不一致时重新计算
+    def put(self, path, filename, digest=None, chunk_size=None, folder=""):
+        if digest is None or chunk_size != self.chunk_size:
+            digest = self._hash_file(path)
+        return self._commit(path, digest + self._ext(filename), folder, os.path.getsize(path))
+
+    def _commit(self, src, filename, folder, size):
+        name = folder + filename
+        if self.backend.exists(name):
+            # 内容相同的文件已存在，刷新修改时间以免被回收
+            os.remove(src)
+            self.backend.touch(name)
+        else:
+            self.backend.save(src, name)
+        self._register(name, size)
+        return filename
+
+    def _register(self, name, size):
+        from app import db
+        from app.models import Upfile
+        try:
+            with db.engine.begin() as conn:
+                conn.execute(Upfile.__table__.insert().values(name=name, size=size, refcount=0))
+        except IntegrityError:
+            pass
+
+    # 根据引用字段的修改历史计算引用数的增减，与本次 flush 在同一事务中更新
+    def _before_flush(self, session, flush_context, instances):
+        references = self.references()
+        deltas = collections.Counter()
+        for obj in itertools.chain(session.new, session.dirty, session.deleted):
+            fields = references.get(type(obj))
+            if not fields:
+                continue
+            deleted = obj in session.deleted
+            for key, folder in fields:
+                hist = attributes.get_history(obj, key)
+                if deleted:
+                    added, removed = (), list(hist.deleted) + list(hist.unchanged)
+                else:
+                    added, removed = hist.added, hist.deleted
+                for v in added:
+                    if v:
+                        deltas[folder + v] += 1
+                for v in removed:
+                    if v:
+                        deltas[folder + v] -= 1
+        deltas = dict((k, v) for k, v in deltas.items() if v)
+        if not deltas:
+            return
+        from app.models import Upfile
+        table = Upfile.__table__
+        conn = session.connection()
+        for name, delta in sorted(deltas.items()):
+            conn.execute(table.update().where(table.c.name == name).values(
+                refcount=table.c.refcount + delta
+            ))
+
+    # 以摘要命名的上传文件内容不会变化，允许浏览器及代理长期缓存
+    def _immutable(self, resp):
+        if request.endpoint == "static" and resp.status_code in (200, 304):
+            filename = (request.view_args or {}).get("filename", "")
+            if DIGEST_NAME.match(os.path.basename(filename)):
+                resp.headers["Cache-Control"] = "public, max-age=%d, immutable" % self.max_age
+        return resp
+
+    # 按引用字段重新计算全部引用数，为尚未登记的已有文件补充记录，返回修正的行数
+    def recount(self, db):
+        from app.models import Upfile
+        counts = collections.Counter()
+        for model, fields in self.references().items():
+            for key, folder in fields:
+                col = getattr(model, key)
+                rows = db.session.query(col, func.count()).filter(col != None, col != "").group_by(col)
+                for name, n in rows:
+                    counts[folder + name] += n
+        db.session.remove()
+        table = Upfile.__table__
+        fixed = 0
+        with db.engine.begin() as conn:
+            for name, refcount in conn.execute(select([table.c.name, table.c.refcount])).fetchall():
+                n = counts.pop(name, 0)
+                if n != refcount:
+                    conn.execute(table.update().where(table.c.name == name).values(refcount=n))
+                    fixed += 1
+            for name, n in sorted(counts.items()):
+                path = self.backend.local_path(name)
+                size = os.path.getsize(path) if path and os.path.exists(path) else None
+                conn.execute(table.insert().values(name=name, size=size, refcount=n))
+                fixed += 1
+        return fixed
+
+    # batch 个文件名中仍被引用的文件名
+    def referenced(self, db, names):
+        found = set()
+        for model, fields in self.references().items():
+            for key, folder in fields:
+                batch = [v[len(folder):] for v in names if v[:v.rfind("/") + 1] == folder]
+                if batch:
+                    col = getattr(model, key)
+                    found.update(folder + v for (v,) in db.session.query(col).filter(col.in_(batch)))
+        return found
+
+    # 逐批遍历存储中的文件，每批排序后与引用字段比对，返回没有任何引用、
+    # 且修改时间早于 before 的文件 [(文件名, 大小), ...]；只在内存中保留一批文件名
+    def orphans(self, db, before, batch=1000):
+        skip = tuple(folder for folder, _ in self._derived)
+        files = (v for v in self.backend.iter_files() if not v[0].startswith(skip))
+        while True:
+            chunk = sorted(itertools.islice(files, batch))
+            if not chunk:
+                break
+            referenced = self.referenced(db, [v[0] for v in chunk])
+            found = [(name, size) for name, mtime, size in chunk if mtime < before and name not in referenced]
+            if found:
+                yield found
+
+    # 删除文件及其派生文件；判断为孤立文件之后又被重新上传（修改时间已刷新）的文件不删除
+    def delete(self, name, before=None):
+        try:
+            if before is not None and self.backend.mtime(name) >= before:
+                return False
+        except OSError:
+            return False
+        self.backend.delete(name)
+        for _, discard in self._derived:
+            discard(name)
+        return True
+
+    def forget(self, db, names):
+        from app.models import Upfile
+        table = Upfile.__table__
+        with db.engine.begin() as conn:
+            conn.execute(table.delete().where(table.c.name.in_(names)))
+
+    # 上传临时目录中早于 before 的残留临时文件
+    def stale_temp(self, before):
+        if not os.path.exists(self.tmp_dir):
+            return
+        for entry in os.scandir(self.tmp_dir):
+            if entry.name.startswith("tmp") and entry.is_file() and entry.stat().st_mtime < before:
+                yield entry.path
+
+
+store = ContentStore()
@@ -0,0 +1,86 @@
+# coding:utf8
+import calendar
+import mimetypes
+import os
+
+from flask import abort, current_app, request
+
+BLOCK_SIZE = 64 * 1024
+
+
+# 不支持 wsgi.file_wrapper 的服务器上按块读取，只返回请求范围内的字节
+def _iter_range(f, start, length):
+    try:
+        f.seek(start)
+        while length > 0:
+            data = f.read(min(BLOCK_SIZE, length))
+            if not data:
+                break
+            length -= len(data)
+            yield data
+    finally:
+        f.close()
+
+
+def _body(f, start, length):
+    file_wrapper = request.environ.get("wsgi.file_wrapper")
+    if file_wrapper is not None:
+        # 交给服务器的 file_wrapper，gunicorn 等会用 sendfile 从当前偏移量发送
+        # Content-Length 个字节，数据不经过 Python 进程
+        f.seek(start)
+        return file_wrapper(f, BLOCK_SIZE)
+    return _iter_range(f, start, length)
+
+
+# 支持 Range 的文件响应
+# 单个范围返回206，多个范围或超出文件长度返回416，If-Range 不匹配时返回完整文件
+def send_range(path, mimetype=None):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        abort(404)
+    size = stat.st_size
+    etag = "%x-%x" % (int(stat.st_mtime), size)
+    if mimetype is None:
+        mimetype = mimetypes.guess_type(path)[0] or "application/octet-stream"
+
+    resp = current_app.response_class(mimetype=mimetype, direct_passthrough=True)
+    resp.headers["Accept-Ranges"] = "bytes"
+    resp.set_etag(etag)
+    resp.last_modified = int(stat.st_mtime)
+    resp.cache_control.public = True
+    resp.cache_control.max_age = 3600
+
+    if request.if_none_match and request.if_none_match.contains(etag):
+        resp.status_code = 304
+        return resp
+
+    byte_range = request.range
+    if byte_range is not None and "If-Range" in request.headers:
+        if_range = request.if_range
+        if if_range.etag is not None:
+            if if_range.etag != etag:
+                byte_range = None
+        elif if_range.date is None or int(stat.st_mtime) > calendar.timegm(if_range.date.utctimetuple()):
+            byte_range = None
+
+    start, length = 0, size
+    if byte_range is not None:
+        if byte_range.units != "bytes" or len(byte_range.ranges) != 1:
+            resp.status_code = 416
+            resp.headers["Content-Range"] = "bytes */%d" % size
+            return resp
+        bounds = byte_range.range_for_length(size)
+        if bounds is None:
+            resp.status_code = 416
+            resp.headers["Content-Range"] = "bytes */%d" % size
+            return resp
+        start, stop = bounds
+        length = stop - start
+        resp.status_code = 206
+        resp.headers["Content-Range"] = "bytes %d-%d/%d" % (start, stop - 1, size)
+
+    resp.content_length = length
+    if request.method != "HEAD":
+        resp.response = _body(open(path, "rb"), start, length)
+    return resp
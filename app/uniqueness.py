@@ -0,0 +1,153 @@
+# coding:utf8
+import hashlib
+import math
+import threading
+import time
+
+from sqlalchemy import event, func, or_
+from sqlalchemy.orm import Session
+
+USER_FIELDS = ("name", "email", "phone")
+
+
+# 布隆过滤器：不在其中的值一定不存在，在其中的值可能存在
+class BloomFilter(object):
+    def __init__(self, capacity, error_rate=0.01):
+        self.capacity = capacity
+        self.size = max(int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)), 64)
+        self.hashes = max(int(round(float(self.size) / capacity * math.log(2))), 1)
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    # 由一次 sha256 的两段结果组合出 hashes 个位置
+    def _positions(self, value):
+        digest = hashlib.sha256(value.encode("utf8")).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:16], "little") | 1
+        for i in range(self.hashes):
+            yield (h1 + i * h2) % self.size
+
+    def add(self, value):
+        for p in self._positions(value):
+            self.bits[p >> 3] |= 1 << (p & 7)
+        self.count += 1
+
+    def __contains__(self, value):
+        return all(self.bits[p >> 3] & (1 << (p & 7)) for p in self._positions(value))
+
+
+# 与 utf8_general_ci 的比较规则保持一致：不区分大小写，忽略末尾空格
+def normalize(value):
+    return value.rstrip().lower()
+
+
+# 会员昵称、邮箱、手机号的唯一性检查
+# 每个字段一个布隆过滤器，不在过滤器中的值直接判定为可用；可能已存在的字段合并为一条查询确认。
+# 本进程提交的会员新增及修改在提交后加入过滤器，其他进程的写入依靠 TTL 到期后重建；
+# 过滤器漏判时由数据库的唯一约束拒绝写入
+class UserUniqueness(object):
+    def __init__(self, ttl=600, error_rate=0.01, min_capacity=10000):
+        self.ttl = ttl
+        self.error_rate = error_rate
+        self.min_capacity = min_capacity
+        self._lock = threading.Lock()
+        self._build_lock = threading.Lock()
+        self._filters = None
+        self._expires = 0
+        self._pending = None
+
+    def init_app(self, app):
+        self.ttl = app.config.get("UNIQUE_FILTER_TTL", self.ttl)
+        self.error_rate = app.config.get("UNIQUE_FILTER_ERROR_RATE", self.error_rate)
+        event.listen(Session, "after_flush", self._after_flush)
+        event.listen(Session, "after_commit", self._after_commit)
+        event.listen(Session, "after_soft_rollback", self._after_rollback)
+
+    def _after_flush(self, session, flush_context):
+        values = session.info.setdefault("unique_user_values", [])
+        for obj in list(session.new) + list(session.dirty):
+            if getattr(obj, "__tablename__", None) == "user":
+                values.append(tuple(getattr(obj, k) for k in USER_FIELDS))
+
+    def _after_commit(self, session):
+        for v in session.info.pop("unique_user_values", ()):
+            self.add(*v)
+
+    def _after_rollback(self, session, previous_transaction):
+        session.info.pop("unique_user_values", None)
+
+    def add(self, *values):
+        with self._lock:
+            if self._pending is not None:
+                self._pending.append(values)
+            if self._filters is not None:
+                self._add(self._filters, values)
+
+    def _add(self, filters, values):
+        for k, v in zip(USER_FIELDS, values):
+            if v:
+                filters[k].add(normalize(v))
+
+    # 从会员表重建过滤器，容量为现有会员数的两倍，重建期间提交的写入在完成后补入
+    def rebuild(self):
+        from app import db
+        from app.models import User
+        with self._lock:
+            self._pending = []
+        try:
+            count = db.session.query(func.count(User.id)).scalar()
+            capacity = max(self.min_capacity, count * 2)
+            filters = dict((k, BloomFilter(capacity, self.error_rate)) for k in USER_FIELDS)
+            for row in db.session.query(User.name, User.email, User.phone).yield_per(5000):
+                self._add(filters, row)
+        except Exception:
+            with self._lock:
+                self._pending = None
+            raise
+        with self._lock:
+            for values in self._pending:
+                self._add(filters, values)
+            self._pending = None
+            self._filters = filters
+            self._expires = time.time() + self.ttl
+
+    # 当前可用的过滤器；过期或超出容量时由一个线程重建，其他线程继续使用旧的过滤器
+    def filters(self):
+        filters = self._filters
+        if filters is not None and self._expires > time.time() and \
+                all(v.count <= v.capacity for v in filters.values()):
+            return filters
+        if self._build_lock.acquire(filters is None):
+            try:
+                if self._filters is filters:
+                    self.rebuild()
+            finally:
+                self._build_lock.release()
+        return self._filters
+
+    # 返回已被其他会员占用的字段名集合，exclude_id 为修改资料时的会员本人
+    def taken(self, exclude_id=None, **values):
+        from app import db
+        from app.models import User
+        filters = self.filters()
+        maybe = dict(
+            (k, v) for k, v in values.items()
+            if v and (filters is None or normalize(v) in filters[k])
+        )
+        if not maybe:
+            return set()
+        rows = db.session.query(User.id, User.name, User.email, User.phone).filter(
+            or_(*[getattr(User, k) == v for k, v in maybe.items()])
+        ).all()
+        taken = set()
+        for row in rows:
+            if row.id == exclude_id:
+                continue
+            for k, v in maybe.items():
+                current = getattr(row, k)
+                if current is not None and normalize(current) == normalize(v):
+                    taken.add(k)
+        return taken
+
+
+user_uniqueness = UserUniqueness()
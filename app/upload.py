@@ -0,0 +1,167 @@
+# coding:utf8
+import hashlib
+import json
+import os
+import time
+import uuid
+
+DIGEST_SIZE = 32
+BLOCK_SIZE = 64 * 1024
+
+
+# 分块断点续传
+# 每个上传会话在临时目录下有三个文件：
+#   <id>.json 文件名、大小、分块大小等元数据
+#   <id>.part 按最终大小预先分配，每个分块直接写入自己的偏移量
+#   <id>.sums 每个分块的 sha256 摘要，32字节一格，非零即表示该分块已收到
+# 分块可以乱序、并发或断线后重传；整个文件的校验值为所有分块摘要拼接后的 sha256，
+# 在分块到达时边写边算，完成时不需要重新读取文件
+class ChunkedUpload(object):
+    def __init__(self, root=None, chunk_size=8 * 1024 * 1024, max_size=4 * 1024 * 1024 * 1024):
+        self.root = root
+        self.chunk_size = chunk_size
+        self.max_size = max_size
+
+    def init_app(self, app):
+        self.root = app.config.get("UPLOAD_TMP_DIR", self.root)
+        self.chunk_size = app.config.get("UPLOAD_CHUNK_SIZE", self.chunk_size)
+        self.max_size = app.config.get("UPLOAD_MAX_SIZE", self.max_size)
+
+    def _path(self, upload_id, ext):
+        if not upload_id.isalnum():
+            raise ValueError("上传会话不存在")
+        return os.path.join(self.root, upload_id + ext)
+
+    def _meta(self, upload_id):
+        try:
+            with open(self._path(upload_id, ".json")) as f:
+                return json.load(f)
+        except (IOError, OSError):
+            raise ValueError("上传会话不存在")
+
+    def _save_meta(self, upload_id, meta):
+        tmp = self._path(upload_id, ".json.tmp")
+        with open(tmp, "w") as f:
+            json.dump(meta, f)
+        os.rename(tmp, self._path(upload_id, ".json"))
+
+    @staticmethod
+    def _chunks(meta):
+        return max(1, (meta["size"] + meta["chunk_size"] - 1) // meta["chunk_size"])
+
+    # 创建上传会话
+    def create(self, filename, size):
+        if size < 0:
+            raise ValueError("文件大小不正确")
+        if size > self.max_size:
+            raise ValueError("文件不能超过%d字节" % self.max_size)
+        if not os.path.exists(self.root):
+            os.makedirs(self.root)
+        upload_id = uuid.uuid4().hex
+        meta = dict(filename=filename, size=size, chunk_size=self.chunk_size, created=time.time())
+        with open(self._path(upload_id, ".part"), "wb") as f:
+            f.truncate(size)
+        with open(self._path(upload_id, ".sums"), "wb") as f:
+            f.truncate(self._chunks(meta) * DIGEST_SIZE)
+        self._save_meta(upload_id, meta)
+        return self.status(upload_id)
+
+    # 已收到的分块，客户端据此续传缺失的分块
+    def status(self, upload_id):
+        meta = self._meta(upload_id)
+        with open(self._path(upload_id, ".sums"), "rb") as f:
+            sums = f.read()
+        empty = b"\0" * DIGEST_SIZE
+        received = [
+            i for i in range(self._chunks(meta))
+            if sums[i * DIGEST_SIZE:(i + 1) * DIGEST_SIZE] != empty
+        ]
+        return dict(
+            id=upload_id,
+            filename=meta["filename"],
+            size=meta["size"],
+            chunk_size=meta["chunk_size"],
+            chunks=self._chunks(meta),
+            received=received,
+            checksum=meta.get("checksum")
+        )
+
+    # 从 stream 读取第 index 个分块并写入其最终位置，checksum 为客户端计算的该分块 sha256
+    def write_chunk(self, upload_id, index, stream, checksum=None):
+        meta = self._meta(upload_id)
+        if index < 0 or index >= self._chunks(meta):
+            raise ValueError("分块序号不正确")
+        offset = index * meta["chunk_size"]
+        expected = min(meta["chunk_size"], meta["size"] - offset)
+        digest = hashlib.sha256()
+        written = 0
+        fd = os.open(self._path(upload_id, ".part"), os.O_WRONLY)
+        try:
+            while written < expected:
+                data = stream.read(min(BLOCK_SIZE, expected - written))
+                if not data:
+                    break
+                os.pwrite(fd, data, offset + written)
+                digest.update(data)
+                written += len(data)
+        finally:
+            os.close(fd)
+        if written != expected or stream.read(1):
+            raise ValueError("分块大小不正确")
+        if checksum and checksum.lower() != digest.hexdigest():
+            raise ValueError("分块校验失败")
+        fd = os.open(self._path(upload_id, ".sums"), os.O_WRONLY)
+        try:
+            os.pwrite(fd, digest.digest(), index * DIGEST_SIZE)
+        finally:
+            os.close(fd)
+        return digest.hexdigest()
+
+    # 全部分块到齐后计算整个文件的校验值
+    def finish(self, upload_id):
+        status = self.status(upload_id)
+        if len(status["received"]) != status["chunks"]:
+            raise ValueError("文件尚未上传完成")
+        with open(self._path(upload_id, ".sums"), "rb") as f:
+            checksum = hashlib.sha256(f.read()).hexdigest()
+        meta = self._meta(upload_id)
+        meta["checksum"] = checksum
+        self._save_meta(upload_id, meta)
+        status["checksum"] = checksum
+        return status
+
+    # 将已完成的上传交给 save(文件路径, 元数据) 保存，并清理会话，返回 save 的结果
+    def claim(self, upload_id, save):
+        meta = self._meta(upload_id)
+        if not meta.get("checksum"):
+            raise ValueError("文件尚未上传完成")
+        result = save(self._path(upload_id, ".part"), meta)
+        self.discard(upload_id)
+        return result
+
+    # 最后一次写入早于 before 的上传会话，视为已放弃
+    def expired(self, before):
+        if not os.path.exists(self.root):
+            return
+        for entry in os.scandir(self.root):
+            if not entry.name.endswith(".json"):
+                continue
+            upload_id = entry.name[:-len(".json")]
+            mtimes = []
+            for ext in (".json", ".part", ".sums"):
+                try:
+                    mtimes.append(os.path.getmtime(self._path(upload_id, ext)))
+                except (OSError, ValueError):
+                    pass
+            if mtimes and max(mtimes) < before:
+                yield upload_id
+
+    def discard(self, upload_id):
+        for ext in (".part", ".sums", ".json"):
+            try:
+                os.remove(self._path(upload_id, ext))
+            except OSError:
+                pass
+
+
+chunked_upload = ChunkedUpload()
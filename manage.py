@@ -1,8 +1,282 @@
 # coding:utf8
-from app import app
+from app import app, db
 from flask_script import Manager
 
 manager = Manager(app)
 
+
+# 校准电影评论数及播放量
+@manager.command
+def recount(batch=1000):
+    from app.counters import reconcile_counters
+    result = reconcile_counters(db, batch=int(batch))
+    print("checked %(checked)d movies, fixed commentnum %(commentnum)d, playnum %(playnum)d" % result)
+
+
+# 把电影表中为空的播放量及评论数改为 0，并在 MySQL 上把这两列改为 NOT NULL DEFAULT 0
+@manager.command
+def counters_not_null():
+    from app.models import Movie
+    table = Movie.__table__
+    with db.engine.begin() as conn:
+        for col in (table.c.playnum, table.c.commentnum):
+            result = conn.execute(table.update().where(col.is_(None)).values({col.name: 0}))
+            print("set %d null %s to 0" % (result.rowcount, col.name))
+            if db.engine.dialect.name == "mysql":
+                conn.execute("ALTER TABLE movie MODIFY %s BIGINT NOT NULL DEFAULT 0" % col.name)
+
+
+# 创建模型中声明但数据库中尚不存在的表及索引
+@manager.command
+def create_indexes():
+    from sqlalchemy import inspect
+    db.create_all()
+    inspector = inspect(db.engine)
+    for table in db.metadata.sorted_tables:
+        names = set(v["name"] for v in inspector.get_indexes(table.name))
+        for index in table.indexes:
+            if index.name not in names:
+                index.create(db.engine)
+                print("created %s" % index.name)
+
+
+# 迁移：上传文件按内容去重后，同一文件可以被多条记录引用，删除这四个字段上原有的唯一索引
+@manager.command
+def drop_upload_unique(dry_run=False):
+    from sqlalchemy import inspect
+    inspector = inspect(db.engine)
+    quote = db.engine.dialect.identifier_preparer.quote
+    action = "would drop" if dry_run else "dropped"
+    for table, column in (("movie", "url"), ("movie", "logo"), ("preview", "logo"), ("user", "face")):
+        for v in inspector.get_indexes(table):
+            if v["unique"] and v["column_names"] == [column]:
+                if not dry_run:
+                    db.engine.execute("ALTER TABLE %s DROP INDEX %s" % (quote(table), quote(v["name"])))
+                print("%s unique %s on %s.%s" % (action, v["name"], table, column))
+
+
+# 对首页每一种 tid/star/time/pm/cm 组合执行 EXPLAIN，检查是否出现全表扫描或 filesort
+# 同时按多个字段排序的组合无法用单个索引覆盖，只做提示不计为失败
+@manager.command
+def explain_index():
+    import itertools
+    import sys
+    from sqlalchemy import text
+    from sqlalchemy.dialects import mysql
+    from app.home.views import index_query
+    from app.pagination import keyset_keys, keyset_order_by
+    failed = 0
+    for tid, star, time, pm, cm in itertools.product((0, 1), (0, 1), (0, 1, 2), (0, 1, 2), (0, 1, 2)):
+        query, order = index_query(tid, star, time, pm, cm)
+        query = query.order_by(*keyset_order_by(keyset_keys(query, order))).limit(11)
+        sql = str(query.statement.compile(dialect=mysql.dialect(), compile_kwargs={"literal_binds": True}))
+        rows = db.session.execute(text("EXPLAIN " + sql)).fetchall()
+        bad = [v for v in rows if v.type == "ALL" or "filesort" in (v.Extra or "")]
+        if not bad:
+            status = "ok"
+        elif len(order) > 1:
+            status = "multi-sort"
+        else:
+            status = "FAIL"
+            failed += 1
+        print("%-10s tid=%d star=%d time=%d pm=%d cm=%d %s" % (
+            status, tid, star, time, pm, cm,
+            "; ".join("%s %s %s" % (v.type, v.key, v.Extra) for v in rows)
+        ))
+    if failed:
+        sys.exit(1)
+
+
+# 重建片名检索索引，并通知同一主机上的其他进程重新构建
+@manager.command
+def search_rebuild():
+    from app.search import title_index
+    print("indexed %d movies" % title_index.rebuild(notify=True))
+
+
+# 为已有的电影及预告封面补生成缩略图，并删除旧版本路径中不含种类的缩略图
+@manager.command
+def media_rebuild():
+    from app.media import media
+    from app.models import Movie, Preview
+    count = 0
+    logos = set()
+    for model, kind in ((Movie, "movie"), (Preview, "preview")):
+        for (logo,) in db.session.query(model.logo).yield_per(1000):
+            if logo:
+                logos.add(logo)
+                try:
+                    media.generate(logo, kind)
+                    count += 1
+                except (IOError, OSError) as e:
+                    print("skip %s: %s" % (logo, e))
+    for logo in logos:
+        media.discard_legacy(logo)
+    print("generated variants for %d images" % count)
+
+
+# 重新计算上传文件的引用数，并为已有文件补充登记
+@manager.command
+def store_recount():
+    from app.store import store
+    print("fixed %d upload records" % store.recount(db))
+
+
+# 把上传目录中平铺存放的旧文件迁移到分散的子目录，可以在网站运行时执行
+@manager.command
+def storage_migrate(workers=8):
+    from app.store import store
+    if not hasattr(store.backend, "migrate"):
+        print("%s does not need migration" % type(store.backend).__name__)
+        return
+    print("migrated %d files" % store.backend.migrate(workers=int(workers), log=print))
+
+
+# 回收没有被引用的上传文件、超时未完成的分块上传及残留的临时文件
+# grace 秒内修改过的文件可能仍在上传或尚未写入数据库，不回收
+@manager.command
+def upload_gc(dry_run=False, grace=86400, batch=1000, workers=8):
+    import os
+    import time
+    from concurrent.futures import ThreadPoolExecutor
+    from app.store import store
+    from app.upload import chunked_upload
+    before = time.time() - int(grace)
+    action = "would delete" if dry_run else "delete"
+    count = size = 0
+    with ThreadPoolExecutor(max_workers=int(workers)) as pool:
+        for orphans in store.orphans(db, before, batch=int(batch)):
+            names = [name for name, _ in orphans]
+            if dry_run:
+                deleted = [True] * len(names)
+            else:
+                deleted = list(pool.map(lambda name: store.delete(name, before), names))
+                store.forget(db, [name for name, ok in zip(names, deleted) if ok])
+            for (name, n), ok in zip(orphans, deleted):
+                if ok:
+                    print("%s %s %d" % (action, name, n))
+                    count += 1
+                    size += n
+        db.session.remove()
+    uploads = 0
+    for upload_id in list(chunked_upload.expired(before)):
+        print("%s upload %s" % (action, upload_id))
+        if not dry_run:
+            chunked_upload.discard(upload_id)
+        uploads += 1
+    for path in list(store.stale_temp(before)):
+        print("%s temp %s" % (action, path))
+        if not dry_run:
+            os.remove(path)
+    print("%s %d orphaned files (%d bytes), %d abandoned uploads" % (action, count, size, uploads))
+
+
+# 列表页面的 SQL 语句数预算：每个页面请求两次，缓存预热后的第二次不得超过预算，超出时以状态码1退出
+@manager.command
+def query_budget():
+    import re
+    import sys
+    from flask import url_for
+    from app.models import Admin, Movie, User
+    from app.profiler import sql_profiler
+    user = User.query.first()
+    admin = Admin.query.filter_by(is_super=0).first()
+    movie = Movie.query.first()
+    db.session.remove()
+    if user is None or admin is None or movie is None:
+        print("need at least one user, one super admin and one movie")
+        sys.exit(1)
+    with app.test_request_context():
+        budgets = [
+            (url_for("home.comments", page=1), 1),
+            (url_for("home.moviecol", page=1), 1),
+            (url_for("home.play", id=movie.id, page=1), 2),
+            (url_for("admin.movie_list", page=1), 1),
+            (url_for("admin.comment_list", page=1), 1),
+            (url_for("admin.moviecol_list", page=1), 1),
+            (url_for("admin.oplog_list", page=1), 1),
+            (url_for("admin.adminloginlog_list", page=1), 1),
+            (url_for("admin.userloginlog_list", page=1), 1),
+        ]
+    sample, sql_profiler.sample = sql_profiler.sample, 1.0
+    failed = 0
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess["user"], sess["user_id"] = user.name, user.id
+        sess["admin"], sess["admin_id"] = admin.name, admin.id
+    try:
+        for url, budget in budgets:
+            client.get(url)
+            resp = client.get(url)
+            match = re.search(r"queries=(\d+)", resp.headers.get("X-SQL-Profile", ""))
+            queries = int(match.group(1)) if match else -1
+            status = "ok" if resp.status_code == 200 and 0 <= queries <= budget else "FAIL"
+            if status != "ok":
+                failed += 1
+            print("%-4s %-40s status=%d queries=%d budget=%d" % (status, url, resp.status_code, queries, budget))
+    finally:
+        sql_profiler.sample = sample
+    if failed:
+        sys.exit(1)
+
+
+# 比较首页列表按完整实体加载（含 info）、完整实体（info 延迟加载）与按列投影三种方式，
+# 每页 rows 行时的平均耗时及结果占用的内存
+@manager.command
+def bench_lean(rows="10,50,500", times=20):
+    import time
+    import tracemalloc
+    from sqlalchemy.orm import undefer
+    from app.models import Movie
+    from app.home.views import INDEX_COLUMNS
+    modes = (
+        ("entity+info", lambda: Movie.query.options(undefer("info"))),
+        ("entity", lambda: Movie.query),
+        ("lean", lambda: db.session.query(*INDEX_COLUMNS)),
+    )
+    print("%-6s %-12s %10s %12s" % ("rows", "mode", "ms/page", "KiB/page"))
+    for n in [int(v) for v in rows.split(",")]:
+        for name, make in modes:
+            elapsed = 0.0
+            for _ in range(int(times)):
+                db.session.remove()
+                start = time.time()
+                make().order_by(Movie.addtime.desc()).limit(n).all()
+                elapsed += time.time() - start
+            db.session.remove()
+            tracemalloc.start()
+            before = tracemalloc.take_snapshot()
+            items = make().order_by(Movie.addtime.desc()).limit(n).all()
+            size = sum(v.size_diff for v in tracemalloc.take_snapshot().compare_to(before, "filename"))
+            tracemalloc.stop()
+            print("%-6d %-12s %10.2f %12.1f" % (len(items), name, elapsed * 1000 / int(times), size / 1024.0))
+            del items
+    db.session.remove()
+
+
+# 把登录日志及操作日志表转换为按月分区（仅 MySQL），已分区的表跳过
+@manager.command
+def log_partition():
+    from app import log_retention
+    for table in log_retention.tables():
+        if log_retention.partition(table):
+            print("partitioned %s" % table.name)
+        else:
+            print("skip %s" % table.name)
+
+
+# 归档并删除超过保留期的日志，分区表同时补充未来几个月的分区；建议每天由 cron 执行
+@manager.command
+def log_rotate(dry_run=False):
+    from app import log_retention
+    action = "would archive" if dry_run else "archived"
+    for table in log_retention.tables():
+        for label, path, count in log_retention.rotate(table, dry_run=bool(dry_run)):
+            if dry_run:
+                print("%s %s %s" % (action, table.name, label))
+            else:
+                print("%s %s %s: %d rows -> %s" % (action, table.name, label, count, path or "-"))
+
+
 if __name__ == "__main__":
-    app.run()
+    manager.run()